@@ -0,0 +1,315 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Offline benchmark of the bot handlers.
+Runs main.py in process against a local stand-in for the Bot API and feeds the dispatcher
+synthetic workloads: a join raid, the captcha answers to it, chat traffic, @admin mentions,
+a flooding user and a restart with a large store. Nothing is sent to Telegram.
+Every workload prints one line with a fixed set of fields, so runs of different commits can be diffed.
+Usage:
+python3 bench.py --chats 10 --raid 1000 --traffic 5000 --mentions 500 --sessions 50000
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import monotonic, sleep, time
+
+from telegram import Update
+from telegram.ext import Updater
+
+import main
+
+FORMAT_VERSION = 1
+FIELDS = ('updates', 'seconds', 'updates_per_s', 'p50_ms', 'p99_ms', 'persist_ms', 'persist_rows', 'api_calls',
+          'errors')
+
+BOT_USER = {'id': 100, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+ADMIN_USER = {'id': 1, 'is_bot': False, 'first_name': 'admin', 'username': 'admin'}
+
+api_calls = Counter()
+api_calls_lock = threading.Lock()
+api_message_ids = itertools.count(1)
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+# Codes of the captchas by their hash, the bot itself only keeps the hash
+captcha_codes = {}
+
+
+class FakeApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Seconds every call takes, like the round trip to Telegram would
+    latency = 0
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Answers every Bot API method the bot uses with a plausible result"""
+    # Keeps the connections of the bot open, as Telegram does
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with api_calls_lock:
+            api_calls[method] += 1
+        if self.server.latency:
+            sleep(self.server.latency)
+
+        data = json.dumps({'ok': True, 'result': self.result(method, body)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def result(self, method, body):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getChatAdministrators':
+            return [{'user': ADMIN_USER, 'status': 'creator'}, {'user': BOT_USER, 'status': 'administrator'}]
+        if method == 'getMyCommands':
+            return []
+        if method.startswith('send'):
+            # Photos come as multipart, the chat id is only needed to build the message
+            match = re.search(rb'"?chat_id"?\s*[:=]?\s*(?:\r\n\r\n)?"?(-?\d+)', body)
+            chat_id = int(match.group(1)) if match else 0
+            return {'message_id': next(api_message_ids), 'date': int(time()),
+                    'chat': {'id': chat_id, 'type': 'supergroup'}, 'from': BOT_USER}
+        return True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_api(latency):
+    server = FakeApiServer(('127.0.0.1', 0), FakeApiHandler)
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, name='fake_api', daemon=True).start()
+    return server
+
+
+def message_update(bot, chat_id, user_id, **fields):
+    message = {'message_id': next(message_ids), 'date': int(time()),
+               'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'bench'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': 'user', 'username': 'user{}'.format(user_id)}}
+    message.update(fields)
+    return Update.de_json({'update_id': next(update_ids), 'message': message}, bot)
+
+
+def join_raid(bot, chats, count):
+    for n in range(count):
+        user_id = 1000000 + n
+        yield message_update(bot, chats[n % len(chats)], user_id, new_chat_members=[
+            {'id': user_id, 'is_bot': False, 'first_name': 'user', 'username': 'user{}'.format(user_id)}])
+
+
+def captcha_answers(bot):
+    # Every other user gets it wrong once before answering right
+    for n, session in enumerate(list(main.sessions.values())):
+        code = captcha_codes[bytes(session.code_hash)]
+        if n % 2:
+            yield message_update(bot, session.chat_id, session.user_id, text=str(int(code) + 1))
+        yield message_update(bot, session.chat_id, session.user_id, text=code)
+
+
+def chat_traffic(bot, chats, count):
+    for n in range(count):
+        text = str(n) if n % 10 == 0 else 'message {} about nothing in particular'.format(n)
+        yield message_update(bot, chats[n % len(chats)], 2000000 + n % 500, text=text)
+
+
+def flood(bot, chats, count):
+    # One user per chat mentioning the admins over and over, most of it is dropped on arrival
+    for n in range(count):
+        yield message_update(bot, chats[n % len(chats)], 5000000, text='@admin {}'.format(n))
+
+
+def admin_mentions(bot, chats, count):
+    for n in range(count):
+        yield message_update(bot, chats[n % len(chats)], 3000000 + n, text='@admin look at this, please')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def persist():
+    """Flush the pending session changes, returns (milliseconds, rows)"""
+    rows = len(main.pending_sessions)
+    started = monotonic()
+    main.flush_sessions()
+    return (monotonic() - started) * 1000, rows
+
+
+def wait_outbound():
+    """Wait for everything the workload sent on, like replies sent with send_later and the shared captchas"""
+    while True:
+        calls_before = sum(api_calls.values())
+        while (main.raid_batches or main.outbound_queue_depth() or not main.deletion_queue.empty()
+               or any(thread.name == 'raid_captcha' for thread in threading.enumerate())):
+            sleep(0.01)
+        # A worker only picks up a barrier call once its previous call is done
+        barrier = threading.Barrier(main.OUTBOUND_SEND_WORKERS + 1)
+        for _ in range(main.OUTBOUND_SEND_WORKERS):
+            main.send(main.PRIORITY_CLEANUP, None, barrier.wait)
+        barrier.wait()
+        # A call may have been on its way to the queue meanwhile
+        if sum(api_calls.values()) == calls_before:
+            return
+
+
+def run_workload(dispatcher, updates, errors):
+    updates = list(updates)
+    calls_before = sum(api_calls.values())
+    errors_before = errors[0]
+    latencies = []
+    started = monotonic()
+    for update in updates:
+        update_started = monotonic()
+        dispatcher.process_update(update)
+        latencies.append(monotonic() - update_started)
+    wait_outbound()
+    elapsed = monotonic() - started
+    persist_ms, persist_rows = persist()
+
+    latencies.sort()
+    return {'updates': len(updates), 'seconds': elapsed, 'updates_per_s': len(updates) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+            'persist_ms': persist_ms, 'persist_rows': persist_rows,
+            'api_calls': sum(api_calls.values()) - calls_before, 'errors': errors[0] - errors_before}
+
+
+def run_restart(bot, chats, count):
+    """Store count sessions, a tenth of them overdue, then time a cold restore of the store"""
+    now = time()
+    for n in range(count):
+        deadline = now - 60 if n % 10 == 0 else now + 3600
+        main.save_session(main.CaptchaSession(chats[n % len(chats)], 4000000 + n, 'user{}'.format(n),
+                                              main.hash_code('{:06d}'.format(n % 1000000)), deadline,
+                                              message_ids=(n, n + 1)))
+    persist_ms, persist_rows = persist()
+    main.close_store()
+
+    main.sessions.clear()
+    main.session_deadlines = main.TimerWheel(main.WHEEL_TICK, main.WHEEL_SLOTS, time())
+    main.chat_settings = {}
+
+    main.sessions_restored.clear()
+    calls_before = sum(api_calls.values())
+    started = monotonic()
+    main.open_store()
+    main.load_config_data()
+    main.restore_sessions(bot)
+    wait_outbound()
+    elapsed = monotonic() - started
+    return {'updates': count, 'seconds': elapsed, 'updates_per_s': count / elapsed,
+            'p50_ms': 0.0, 'p99_ms': 0.0, 'persist_ms': persist_ms, 'persist_rows': persist_rows,
+            'api_calls': sum(api_calls.values()) - calls_before, 'errors': 0}
+
+
+def report(name, result, as_json):
+    if as_json:
+        print(json.dumps(dict(result, workload=name, format=FORMAT_VERSION), sort_keys=True))
+        return
+    values = []
+    for field in FIELDS:
+        value = result[field]
+        values.append('{}={}'.format(field, '{:.3f}'.format(value) if isinstance(value, float) else value))
+    print('{:<16} {}'.format(name, ' '.join(values)))
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description='Benchmark the bot handlers against a stand-in Bot API')
+    parser.add_argument('--chats', type=int, default=10, help='registered chats the updates are spread over')
+    parser.add_argument('--raid', type=int, default=1000, help='users joining in the join raid')
+    parser.add_argument('--traffic', type=int, default=5000, help='plain chat messages')
+    parser.add_argument('--mentions', type=int, default=500, help='messages calling the admins')
+    parser.add_argument('--flood', type=int, default=1000, help='messages of one flooding user per chat')
+    parser.add_argument('--sessions', type=int, default=50000, help='captcha sessions in the store on restart')
+    parser.add_argument('--api-latency', type=float, default=0, help='milliseconds every Bot API call takes')
+    parser.add_argument('--rate-limits', action='store_true', help='keep the outbound rate limits of the bot')
+    parser.add_argument('--json', action='store_true', help='print JSON lines instead of text')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    server = start_fake_api(args.api_latency / 1000)
+
+    main.TOKEN = '123456:bench'
+    main.BOT_API_URL = 'http://127.0.0.1:{}/bot'.format(server.server_port)
+    main.STATE_DB = main.UNSHARDED_STATE_DB = os.path.join(workdir, 'state.sqlite3')
+    main.DATA_PICKLE, main.JOBS_PICKLE, main.TEMP_PICKLE = (os.path.join(workdir, name) for name in
+                                                            ('data.pickle', 'jobs.pickle', 'temp.pickle'))
+    # Sessions are flushed at the end of every workload, where the flush is timed
+    main.SESSIONS_FLUSH_DELAY = main.SESSIONS_FLUSH_MAX_DELAY = 1e9
+    # The last shared captcha of the raid is not worth a long wait
+    main.RAID_BATCH_DELAY = 0.5
+    hash_code = main.hash_code
+
+    def remember_code(code, salt=None):
+        code_hash = hash_code(code, salt)
+        if salt is None:
+            captcha_codes[code_hash] = code
+        return code_hash
+    main.hash_code = remember_code
+    if not args.rate_limits:
+        # The limits would measure Telegram's patience instead of the bot
+        main.OUTBOUND_GLOBAL_RATE = main.OUTBOUND_CHAT_RATE = main.OUTBOUND_CHAT_BURST = 1e9
+
+    updater = Updater(bot=main.make_bot(), use_context=True)
+    dispatcher = updater.dispatcher
+    main.add_handlers(dispatcher)
+    errors = [0]
+
+    def count_error(update, context):
+        errors[0] += 1
+    dispatcher.add_error_handler(count_error)
+
+    main.start_services(updater)
+    updater.job_queue.start()
+    chats = [-1000000000000 - n for n in range(args.chats)]
+    for chat_id in chats:
+        main.update_chat_settings(chat_id, registered=True)
+
+    main.sessions_restored.wait()
+    # Raids hit a bot that had the time to fill its captcha pool
+    filling_since = monotonic()
+    while not main.captcha_pool.full() and monotonic() - filling_since < 60:
+        sleep(0.1)
+
+    if not args.json:
+        print('# bench format {}'.format(FORMAT_VERSION))
+    try:
+        bot = updater.bot
+        report('join_raid', run_workload(dispatcher, join_raid(bot, chats, args.raid), errors), args.json)
+        report('captcha_answers', run_workload(dispatcher, captcha_answers(bot), errors), args.json)
+        report('chat_traffic', run_workload(dispatcher, chat_traffic(bot, chats, args.traffic), errors), args.json)
+        report('admin_mentions', run_workload(dispatcher, admin_mentions(bot, chats, args.mentions), errors),
+               args.json)
+        report('flood', run_workload(dispatcher, flood(bot, chats, args.flood), errors), args.json)
+        report('restart', run_restart(bot, chats, args.sessions), args.json)
+    finally:
+        updater.job_queue.stop()
+        main.stop_services()
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -13,19 +13,45 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 
+import asyncio
+import heapq
+import hmac
+import itertools
+import json
 import logging
+import math
+import multiprocessing
+import os
 import pickle
+import queue
 import random
 import re
+import signal
+import sqlite3
 import string
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from datetime import timedelta
-from time import time
+from functools import partial, wraps
+from logging.handlers import QueueHandler, QueueListener
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from socketserver import ThreadingMixIn
+from time import monotonic, sleep, time
 
 from claptcha import Claptcha
-from telegram import ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
-from telegram.ext import Updater, MessageHandler, Filters, CommandHandler, Job, \
-    CallbackQueryHandler, ConversationHandler
+from PIL import Image
+from telegram import Bot, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, ParseMode, Update
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Updater, MessageHandler, Filters, CommandHandler, \
+    CallbackQueryHandler, ConversationHandler, DispatcherHandlerStop, TypeHandler
+from telegram.utils.request import Request
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -34,18 +60,56 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 TOKEN = "<YOUR TOKEN HERE>"
+# None is api.telegram.org, bench.py points the bot at its stand-in server
+BOT_API_URL = None
+
+# 'polling' runs the Updater, 'asyncio' handles the updates of different chats concurrently,
+# 'webhook' receives the updates over HTTP, 'sharded' spreads the chats over SHARDS processes
+RUN_MODE = 'polling'
+ASYNC_HANDLER_WORKERS = 32
+ASYNC_POLL_TIMEOUT = 10
+
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+# Public https address of WEBHOOK_LISTEN, the webhook is registered on start when set
+WEBHOOK_URL = None
+WEBHOOK_SECRET = "<WEBHOOK SECRET TOKEN>"
+WEBHOOK_QUEUE_SIZE = 1000
+# Larger requests are refused unread, updates are a few kilobytes
+WEBHOOK_MAX_BODY = 1024 * 1024
+# Accepted updates are appended here as JSON lines, for replay.py
+WEBHOOK_RECORD_FILE = None
+
+# /metrics is served on METRICS_PORT when set, shards use the following ports
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = None
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Log records are written by a background thread, as JSON lines unless LOG_JSON is off. LOG_FILE None is stderr
+LOG_LEVEL = 'INFO'
+LOG_JSON = True
+LOG_FILE = None
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Records beyond LOG_QUEUE_SIZE waiting to be written are dropped
+LOG_QUEUE_SIZE = 10000
+# Debug and info records with these messages are kept for one update in N, all records of an update alike
+LOG_SAMPLING = {'process_message': 100, 'new_chat_members_invite': 10}
+
+SHARDS = 4
+SHARD_QUEUE_SIZE = 1000
+# While a shard is behind, the router checks every SHARD_PUT_TIMEOUT seconds that it's alive and not stopping
+SHARD_PUT_TIMEOUT = 1
+SHARD_STATE_DB = 'state-{}.sqlite3'
 
-INSTANCE_CHAT_ID = set()
 SUPER_ADMIN = "SUPER ADMIN USERNAME WITHOU @"
+# Usernames of the bot admins on the first run, later the ACL in the store is used
 ADMINS = [SUPER_ADMIN]
 
 DEFAULT_CAPTCHA_TIME = 5 * 60
 DEFAULT_WELCOME_MESSAGE = "Welcome!"
 DEFAULT_GOODBYE_MESSAGE = "Bye!"
-
-CAPTCHA_TIME = {}
-WELCOME_MESSAGE = {}
-GOODBYE_MESSAGE = {}
+DEFAULT_ADMIN_TRIGGERS = ("@admin",)
 
 PERSONAL_LINK_CHAT = "chat-links"
 PERSONAL_LINK_PROGRESSOR = "progressor-links"
@@ -55,6 +119,82 @@ PERSONAL_LINK_VK = "vk-links"
 DATA_PICKLE = 'data_values.pickle'
 JOBS_PICKLE = 'job_tuples.pickle'
 TEMP_PICKLE = 'temp.pickle'
+STATE_DB = 'state.sqlite3'
+# Layout of the store, a store written by a newer version is not opened
+STORE_VERSION = 1
+UNSHARDED_STATE_DB = STATE_DB
+
+# Session changes are written once no new ones came in for SESSIONS_FLUSH_DELAY seconds,
+# but never later than SESSIONS_FLUSH_MAX_DELAY seconds after the first unsaved change
+SESSIONS_FLUSH_DELAY = 1
+SESSIONS_FLUSH_MAX_DELAY = 5
+# Stored sessions are restored in the background, this many at a time
+SESSIONS_RESTORE_CHUNK = 1000
+
+CAPTCHA_FONT = "FreeMono.ttf"
+CAPTCHA_POOL_SIZE = 64
+# Captchas are rendered in CAPTCHA_RENDER_PROCESSES processes, 0 renders them on threads.
+# At most CAPTCHA_RENDER_QUEUE renders wait for them, a handler waits CAPTCHA_RENDER_TIMEOUT seconds for its render.
+# Beyond that a smaller, cheaper captcha is rendered in place
+CAPTCHA_RENDER_PROCESSES = os.cpu_count() or 1
+CAPTCHA_RENDER_QUEUE = 4 * CAPTCHA_RENDER_PROCESSES
+CAPTCHA_RENDER_TIMEOUT = 2
+CAPTCHA_FALLBACK_SIZE = (150, 60)
+# Answers to a captcha after CAPTCHA_MAX_ATTEMPTS wrong ones are dropped unread
+CAPTCHA_MAX_ATTEMPTS = 5
+# Key of the hashes the captcha codes are stored as, changing it fails the captchas waiting to be solved
+CAPTCHA_SECRET = "<CAPTCHA SECRET>"
+CAPTCHA_SALT_SIZE = 8
+
+# The last UPDATE_DEDUP_WINDOW update ids are remembered, an update seen again is dropped
+UPDATE_DEDUP_WINDOW = 10000
+# A user's messages beyond FLOOD_MESSAGES within FLOOD_WINDOW seconds in a chat are dropped,
+# the windows of the FLOOD_MAX_USERS most recently active users are kept
+FLOOD_MESSAGES = 20
+FLOOD_WINDOW = 10
+FLOOD_MAX_USERS = 10000
+# Captcha deadlines are checked every WHEEL_TICK seconds, one revolution of the wheel is WHEEL_TICK * WHEEL_SLOTS
+WHEEL_TICK = 1
+WHEEL_SLOTS = 512
+
+# RAID_JOINS joins within RAID_WINDOW seconds start a raid, it ends RAID_COOLDOWN seconds after such a burst.
+# During a raid the newcomers share one captcha, posted RAID_BATCH_DELAY seconds after the first of them joined
+# or as soon as RAID_BATCH_SIZE are waiting
+RAID_JOINS = 10
+RAID_WINDOW = 60
+RAID_COOLDOWN = 5 * 60
+RAID_BATCH_DELAY = 5
+RAID_BATCH_SIZE = 20
+# Also take media, links and invites away from everybody but the admins while the raid lasts
+RAID_RESTRICT = False
+RAID_PERMISSIONS = {'can_send_messages': True, 'can_send_media_messages': False, 'can_send_polls': False,
+                    'can_send_other_messages': False, 'can_add_web_page_previews': False, 'can_invite_users': False}
+
+# Users one /kick, /ban or /mute acts on at most, and joins per chat remembered for their +<time> and @username
+MODERATION_MAX_TARGETS = 100
+RECENT_JOINS = 500
+MUTE_PERMISSIONS = ChatPermissions(can_send_messages=False, can_send_media_messages=False, can_send_polls=False,
+                                   can_send_other_messages=False, can_add_web_page_previews=False,
+                                   can_change_info=False, can_invite_users=False, can_pin_messages=False)
+
+# Bot API limits: about 30 calls per second in total and 20 messages per minute in a group
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_CHAT_RATE = 20 / 60
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_SEND_WORKERS = 8
+OUTBOUND_MAX_CHAT_BUCKETS = 1024
+
+# Lower goes first
+PRIORITY_KICK, PRIORITY_CAPTCHA, PRIORITY_REPLY, PRIORITY_CLEANUP = range(4)
+PRIORITY_NAMES = ('kick', 'captcha', 'reply', 'cleanup')
+
+DELETE_BATCH_SIZE = 100  # deleteMessages limit
+DELETE_MAX_ATTEMPTS = 5
+
+ADMIN_CACHE_TTL = 10 * 60
+ADMIN_CACHE_REFRESH_AHEAD = 60
+ADMIN_CACHE_RECHECK = 30
+ADMIN_CACHE_SIZE = 256
 
 BEGIN, ADMIN, END = range(3)
 LINK_CHAT = "link_chat"
@@ -63,14 +203,207 @@ LINK_DATING = "link_dating"
 LINK_VK = "link_vk"
 ADMIN = "admin"
 RESTART = "restart"
+# Buttons of the /start menu, the callback data of a page is also the name of its setting
+LINK_PAGES = ((LINK_CHAT, "Поличаты"), (LINK_PROGRESSOR, "Матчасть"), (LINK_DATING, "Знакомства"), (LINK_VK, "ВК"))
 
-# WARNING: This information may change in future versions (changes are planned)
+# Layout of the jobs pickled by older versions, only used to migrate them
 JOB_DATA = ('callback', 'interval', 'repeat', 'context', 'days', 'name', 'tzinfo')
 JOB_STATE = ('_remove', '_enabled')
 
-# TODO: move these to job context (somehow)
-captchas = {}
-messages_to_delete = {}
+# (name, sorted label pairs) -> value
+metric_counters = {}
+metric_histograms = {}
+metrics_lock = threading.Lock()
+
+# (chat_id, user_id) -> CaptchaSession
+sessions = {}
+sessions_lock = threading.Lock()
+# Set once the stored sessions are restored, the keys touched before that win over the stored ones
+sessions_restored = threading.Event()
+sessions_touched = set()
+# (chat_id, photo message id) -> sessions showing that captcha, the photo is deleted with the last of them
+captcha_photo_refs = Counter()
+
+# Recent update ids, in the order they came in
+seen_update_ids = set()
+seen_update_order = deque()
+# (chat_id, user_id) -> times of their last accepted messages, least recently active first
+flood_windows = OrderedDict()
+ingest_lock = threading.Lock()
+
+# update_id, chat_id and user_id of the update the thread is handling, for the log records
+log_context = threading.local()
+log_listener = None
+
+# chat_id -> times of the last RAID_JOINS joins
+join_times = {}
+# chat_id -> end of the raid, pushed back by every burst
+raid_until = {}
+# chat_id -> users waiting for the next shared captcha, and the job posting it after RAID_BATCH_DELAY
+raid_batches = {}
+raid_batch_jobs = {}
+# chat_id -> permissions the chat had before the raid restricted it
+raid_restrictions = {}
+raid_lock = threading.Lock()
+
+# chat_id -> (time, user_id, username) of the last RECENT_JOINS joins
+recent_joins = {}
+recent_joins_lock = threading.Lock()
+
+# Pre-rendered (code, png bytes) pairs, filled in the background
+captcha_pool = queue.Queue(maxsize=CAPTCHA_POOL_SIZE)
+captcha_renderer = None
+captcha_fallback_renderer = None
+# Separate locks, the render processes are forked while a handler may hold the fallback one
+captcha_renderer_lock = threading.Lock()
+captcha_fallback_lock = threading.Lock()
+captcha_render_pool = None
+captcha_render_stopping = False
+captcha_render_slots = threading.BoundedSemaphore(CAPTCHA_RENDER_QUEUE)
+
+# Heap of (priority, seq, enqueued_at, chat_id, future, call) waiting for the rate limits
+outbound_queue = []
+outbound_seq = itertools.count()
+outbound_condition = threading.Condition()
+outbound_global_bucket = None
+outbound_chat_buckets = {}
+outbound_worker = None
+outbound_executor = None
+outbound_stopping = False
+outbound_stats = {name: {'sent': 0, 'wait_total': 0.0, 'wait_max': 0.0} for name in PRIORITY_NAMES}
+
+# (chat_id, message ids) to delete, None stops the worker
+deletion_queue = queue.Queue()
+deletion_worker = None
+
+# Updates accepted by the webhook, full queue makes it answer 503
+webhook_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_record = None
+webhook_record_lock = threading.Lock()
+
+# Settings of a chat, None admin_triggers are the default ones and match_trigger is compiled from them
+ChatSettings = namedtuple('ChatSettings', ('registered', 'captcha_time', 'welcome_message', 'goodbye_message',
+                                           'admin_triggers', 'match_trigger'))
+# chat_id -> ChatSettings, never changed in place: a writer replaces the whole dict, so readers need no lock
+chat_settings = {}
+chat_settings_lock = threading.Lock()
+
+# chat_id -> AdminCacheEntry, least recently used first
+AdminCacheEntry = namedtuple('AdminCacheEntry', ('fetched_at', 'admins', 'user_ids'))
+admin_cache = OrderedDict()
+admin_cache_lock = threading.Lock()
+
+# chat_id -> Acl of the users with a role in that chat, None is the whole bot
+acls = {}
+acl_lock = threading.Lock()
+
+# (menu, variant) -> (text, keyboard JSON), built on first use and dropped when the links or admins change
+menu_cache = {}
+menu_cache_lock = threading.Lock()
+
+store = None
+store_lock = threading.RLock()
+
+# (chat_id, user_id) -> session row to write, or None to delete it
+pending_sessions = {}
+# Wakes the flusher on the first change after a flush, it sleeps while nothing changes
+pending_sessions_condition = threading.Condition()
+pending_sessions_first_change = None
+pending_sessions_last_change = None
+pending_sessions_changes = 0
+sessions_flusher = None
+sessions_flusher_stopping = False
+sessions_flush_stats = {'flushes': 0, 'changes': 0, 'coalesced': 0, 'chats': 0}
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    registered INTEGER NOT NULL,
+    captcha_time INTEGER,
+    welcome_message TEXT,
+    goodbye_message TEXT,
+    admin_triggers TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT,
+    code_hash BLOB NOT NULL,
+    deadline REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    message_ids BLOB NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+"""
+
+
+class UpdateLogFilter(logging.Filter):
+    """Tag records with the update their thread is handling and sample the frequent ones"""
+
+    def filter(self, record):
+        if not hasattr(record, 'update_id'):
+            record.update_id = getattr(log_context, 'update_id', None)
+            record.chat_id = getattr(log_context, 'chat_id', None)
+            record.user_id = getattr(log_context, 'user_id', None)
+        if record.levelno < logging.WARNING and record.update_id is not None and isinstance(record.msg, str):
+            every = LOG_SAMPLING.get(record.msg)
+            if every and record.update_id % every:
+                return False
+        return True
+
+
+class BackgroundLogHandler(QueueHandler):
+    """Queues records as they are, the message is only formatted by the writer thread"""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            count('bot_log_records_dropped_total')
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z', 'level': record.levelname,
+                 'logger': record.name, 'thread': record.threadName, 'message': record.getMessage()}
+        for name in ('update_id', 'chat_id', 'user_id'):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def start_logging():
+    """Hand the records of this process to a writer thread, the shards call it again after the fork"""
+    global log_listener
+    output = logging.FileHandler(LOG_FILE, encoding='utf-8') if LOG_FILE else logging.StreamHandler()
+    output.setFormatter(JsonLogFormatter() if LOG_JSON else logging.Formatter(LOG_TEXT_FORMAT))
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = BackgroundLogHandler(log_queue)
+    handler.addFilter(UpdateLogFilter())
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    log_listener = QueueListener(log_queue, output)
+    log_listener.start()
+
+
+def stop_logging():
+    """Write out the queued records"""
+    if log_listener is not None:
+        log_listener.stop()
 
 
 def random_digit_string(string_length=4):
@@ -78,145 +411,1069 @@ def random_digit_string(string_length=4):
     return ''.join(random.choice(string.digits) for i in range(string_length))
 
 
-def kick_on_time(context):
-    """Send the alarm message."""
-    job = context.job
-    chat_id = job.context[0]
-    username = job.context[1]
-    user_id = job.context[2]
-    context.bot.kick_chat_member(chat_id, user_id,
-                                 until_date=datetime.utcnow() + timedelta(minutes=1))
-    cleanup(chat_id, username, context)
+class Histogram(object):
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        # The last bucket is +Inf
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def count(name, amount=1, **labels):
+    key = name, tuple(sorted(labels.items()))
+    with metrics_lock:
+        metric_counters[key] = metric_counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    key = name, tuple(sorted(labels.items()))
+    with metrics_lock:
+        histogram = metric_histograms.get(key)
+        if histogram is None:
+            histogram = metric_histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def timed(handler):
+    """Record the latency and the errors of a handler"""
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        started = monotonic()
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            count('bot_handler_errors_total', handler=handler.__name__)
+            raise
+        finally:
+            observe('bot_handler_seconds', monotonic() - started, handler=handler.__name__)
+    return wrapper
+
+
+class InstrumentedRequest(Request):
+    """Records every Bot API call by method"""
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        started = monotonic()
+        try:
+            return super().post(url, data, timeout=timeout)
+        except TelegramError as e:
+            count('bot_api_errors_total', method=method, error=type(e).__name__)
+            raise
+        finally:
+            observe('bot_api_seconds', monotonic() - started, method=method)
+
+
+def make_bot():
+    # Every concurrently running handler may hold a connection
+    return Bot(TOKEN, base_url=BOT_API_URL, request=InstrumentedRequest(con_pool_size=ASYNC_HANDLER_WORKERS + 4))
+
+
+def format_labels(labels, **extra):
+    labels = labels + tuple(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def render_metrics():
+    """Current metrics in the Prometheus text format"""
+    gauges = {
+        'bot_captcha_sessions': len(sessions),
+        'bot_captcha_pool_size': captcha_pool.qsize(),
+        'bot_outbound_queue_depth': outbound_queue_depth(),
+        'bot_deletion_queue_depth': deletion_queue.qsize(),
+    }
+    for name, stats in outbound_stats.items():
+        count_key = 'bot_outbound_calls_total', (('priority', name),)
+        wait_key = 'bot_outbound_wait_seconds_total', (('priority', name),)
+        with metrics_lock:
+            metric_counters[count_key] = stats['sent']
+            metric_counters[wait_key] = stats['wait_total']
+    with metrics_lock:
+        metric_counters['bot_session_flushes_total', ()] = sessions_flush_stats['flushes']
+        metric_counters['bot_session_changes_coalesced_total', ()] = sessions_flush_stats['coalesced']
+        counters = sorted(metric_counters.items())
+        histograms = sorted((key, (list(h.counts), h.total, h.count)) for key, h in metric_histograms.items())
+
+    lines = []
+    for name, value in sorted(gauges.items()):
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, value))
+
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {} counter'.format(name))
+        lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+    for (name, labels), (counts, total, observations) in histograms:
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {} histogram'.format(name))
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=bound), cumulative))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), observations))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
 
+def start_metrics_server(port):
+    if port is None:
+        return
+    try:
+        server = MetricsServer((METRICS_LISTEN, port), MetricsHandler)
+    except OSError as e:
+        # Metrics are not worth failing the bot over, e.g. when the port is taken
+        logger.warning('Could not serve metrics on %s:%s: %s', METRICS_LISTEN, port, e)
+        return
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%s/metrics', METRICS_LISTEN, port)
+
+
+class CaptchaSession(object):
+    """A captcha waiting to be solved by a user in a chat"""
+    __slots__ = ('chat_id', 'user_id', 'username', 'code_hash', 'deadline', 'attempts', 'message_ids')
+
+    def __init__(self, chat_id, user_id, username, code_hash, deadline, attempts=0, message_ids=()):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.username = username
+        # The code itself is never kept, see hash_code
+        self.code_hash = code_hash
+        self.deadline = deadline
+        self.attempts = attempts
+        # Captcha photo, wrong answers and the replies to them
+        self.message_ids = array('q', message_ids)
+
+
+def hash_code(code, salt=None):
+    """Salted HMAC of a captcha code, the salt goes in front of the digest"""
+    if salt is None:
+        salt = os.urandom(CAPTCHA_SALT_SIZE)
+    digest = hmac.new(CAPTCHA_SECRET.encode('utf-8'), salt + code.casefold().encode('utf-8'), 'sha256').digest()
+    return salt + digest[:16]
+
+
+def code_matches(code_hash, answer):
+    return hmac.compare_digest(hash_code(answer, code_hash[:CAPTCHA_SALT_SIZE]), code_hash)
+
+
+class TimerWheel(object):
+    """Hashed timing wheel, arms and cancels in O(1) and expires a whole tick at once
+
+    Deadlines further away than one revolution stay in their slot until the revolution they are due in."""
+    __slots__ = ('tick', 'slots', 'slot_of', 'current')
+
+    def __init__(self, tick, size, now):
+        self.tick = tick
+        # key -> deadline
+        self.slots = [{} for _ in range(size)]
+        self.slot_of = {}
+        # Number of the last tick that was expired
+        self.current = int(now // tick)
+
+    def arm(self, key, deadline):
+        self.cancel(key)
+        # First tick at or after the deadline, overdue keys go to the next tick
+        tick_number = max(math.ceil(deadline / self.tick), self.current + 1)
+        slot = tick_number % len(self.slots)
+        self.slots[slot][key] = deadline
+        self.slot_of[key] = slot
+
+    def cancel(self, key):
+        slot = self.slot_of.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self, now):
+        """Remove and return the keys whose deadline passed"""
+        expired = []
+        target = int(now // self.tick)
+        # After a long pause every slot is visited once
+        for tick_number in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick_number % len(self.slots)]
+            due = [key for key, deadline in slot.items() if deadline <= now]
+            for key in due:
+                del slot[key]
+                del self.slot_of[key]
+            expired.extend(due)
+        self.current = max(self.current, target)
+        return expired
+
+    def __len__(self):
+        return len(self.slot_of)
+
+
+class Acl(object):
+    """Users holding a role, by user id
+
+    A username given before its user was seen is pending until that user shows up."""
+    __slots__ = ('members', 'ids_by_name', 'pending')
+
+    def __init__(self):
+        # user_id -> username, lower-cased username -> user_id
+        self.members = {}
+        self.ids_by_name = {}
+        self.pending = set()
+
+    def add(self, user_id, username):
+        old_username = self.members.get(user_id)
+        if old_username:
+            self.ids_by_name.pop(old_username.lower(), None)
+        self.members[user_id] = username
+        if username:
+            self.ids_by_name[username.lower()] = user_id
+            self.pending.discard(username.lower())
+
+    def add_name(self, username):
+        if username.lower() not in self.ids_by_name:
+            self.pending.add(username.lower())
+
+    def remove(self, user_id, username):
+        """Remove a member by id or username, returns whether there was one"""
+        removed = False
+        if username:
+            if username.lower() in self.pending:
+                self.pending.discard(username.lower())
+                removed = True
+            if user_id is None:
+                user_id = self.ids_by_name.get(username.lower())
+        if user_id in self.members:
+            old_username = self.members.pop(user_id)
+            if old_username:
+                self.ids_by_name.pop(old_username.lower(), None)
+            removed = True
+        return removed
+
+
+# (chat_id, user_id) of the sessions, by deadline
+session_deadlines = TimerWheel(WHEEL_TICK, WHEEL_SLOTS, time())
+
+
+def add_session(session):
+    with sessions_lock:
+        key = session.chat_id, session.user_id
+        if key in sessions:
+            release_captcha_photo(sessions[key])
+        hold_captcha_photo(session)
+        sessions[key] = session
+        session_deadlines.arm(key, session.deadline)
+        if not sessions_restored.is_set():
+            sessions_touched.add(key)
+
+
+def restore_session(session):
+    """Add a stored session, unless it changed since the start"""
+    with sessions_lock:
+        key = session.chat_id, session.user_id
+        if key in sessions_touched:
+            return False
+        hold_captcha_photo(session)
+        sessions[key] = session
+        session_deadlines.arm(key, session.deadline)
+        return True
+
+
+def get_session(chat_id, user_id):
+    return sessions.get((chat_id, user_id))
+
+
+def load_session(chat_id, user_id):
+    """Look a session the restore didn't get to yet up in the store"""
+    with store_lock:
+        row = store.execute('SELECT * FROM sessions WHERE chat_id = ? AND user_id = ? AND deadline > ?',
+                            (chat_id, user_id, time())).fetchone()
+    key = chat_id, user_id
+    with sessions_lock:
+        # The restore may have got there meanwhile, and a touched session is gone from memory for good
+        if row is None or key in sessions or key in sessions_touched or sessions_restored.is_set():
+            return sessions.get(key)
+        chat_id, user_id, username, code_hash, deadline, attempts, message_ids = row
+        session = CaptchaSession(chat_id, user_id, username, code_hash, deadline, attempts, array('q', message_ids))
+        hold_captcha_photo(session)
+        sessions[key] = session
+        session_deadlines.arm(key, session.deadline)
+        # Skipped by the restore from now on
+        sessions_touched.add(key)
+        return session
+
+
+def pop_session(chat_id, user_id):
+    with sessions_lock:
+        if not sessions_restored.is_set():
+            sessions_touched.add((chat_id, user_id))
+        session_deadlines.cancel((chat_id, user_id))
+        session = sessions.pop((chat_id, user_id), None)
+        if session is not None:
+            release_captcha_photo(session)
+        return session
+
+
+def pop_expired_sessions(now):
+    """Remove and return the sessions whose deadline passed"""
+    with sessions_lock:
+        expired = [sessions.pop(key) for key in session_deadlines.advance(now)]
+        for session in expired:
+            release_captcha_photo(session)
+        return expired
+
+
+def keep_session_message(session, future):
+    """Add the message a send() future posts to the session's messages once it's sent
+
+    The handlers don't wait for it, a busy chat's rate limit would hold up every other chat."""
+    def sent(future):
+        if future.exception() is not None:
+            log_send_error(future)
+            return
+        message_id = future.result().message_id
+        with sessions_lock:
+            current = sessions.get((session.chat_id, session.user_id)) is session
+            if current:
+                session.message_ids.append(message_id)
+        if current:
+            save_session(session)
+        else:
+            # The session ended before the message went out
+            deletion_queue.put((session.chat_id, [message_id]))
+    future.add_done_callback(sent)
+
+
+def hold_captcha_photo(session):
+    # The photo of a shared captcha is the first message of its sessions
+    if session.message_ids:
+        captcha_photo_refs[session.chat_id, session.message_ids[0]] += 1
+
+
+def release_captcha_photo(session):
+    """Keep a shared captcha photo out of the messages to delete while other sessions still show it"""
+    if not session.message_ids:
+        return
+    key = session.chat_id, session.message_ids[0]
+    if captcha_photo_refs[key] > 1:
+        captcha_photo_refs[key] -= 1
+        del session.message_ids[0]
+    else:
+        del captcha_photo_refs[key]
 
-def cleanup(chat_id, username, context):
-    if username in messages_to_delete[chat_id]:
-        for msg_id in messages_to_delete[chat_id][username]:
-            context.bot.delete_message(chat_id, msg_id)
-        del messages_to_delete[chat_id][username]
-        del captchas[chat_id][username]
 
+@timed
+def expire_captchas_job(context):
+    """Kick everybody whose captcha deadline passed since the last tick"""
+    expired = pop_expired_sessions(time())
+    if expired:
+        logger.debug('expire_captchas_job() %s captchas', len(expired))
+    count('bot_captchas_total', len(expired), result='expired')
+    for session in expired:
+        send_later(PRIORITY_KICK, None, context.bot.kick_chat_member, session.chat_id, session.user_id,
+                   until_date=datetime.utcnow() + timedelta(minutes=1))
+        deletion_queue.put((session.chat_id, list(session.message_ids)))
+        delete_session(session.chat_id, session.user_id)
 
-def find_whole_word(w):
-    return re.compile(r'(^|[^\w]){}([^\w]|$)'.format(w), flags=re.IGNORECASE).search
 
+@timed
+def cleanup(chat_id, user_id, context):
+    session = pop_session(chat_id, user_id)
+    if session is not None:
+        deletion_queue.put((chat_id, list(session.message_ids)))
+    # A session that is not restored yet is only in the store
+    if session is not None or not sessions_restored.is_set():
+        delete_session(chat_id, user_id)
 
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+def send(priority, chat_id, fn, *args, **kwargs):
+    """Schedule a Bot API call, returns a Future with its result
+
+    Calls with a chat_id count against the chat's message limit as well as the global one."""
+    future = Future()
+    call = partial(fn, *args, **kwargs)
+    if outbound_worker is None:
+        # Scheduler not started, nothing to queue behind
+        run_outbound_call(future, call)
+        return future
+
+    with outbound_condition:
+        heapq.heappush(outbound_queue, (priority, next(outbound_seq), monotonic(), chat_id, future, call))
+        outbound_condition.notify()
+    return future
+
+
+def send_later(priority, chat_id, fn, *args, **kwargs):
+    """Schedule a Bot API call nobody waits for"""
+    send(priority, chat_id, fn, *args, **kwargs).add_done_callback(log_send_error)
+
+
+def log_send_error(future):
+    if future.exception() is not None:
+        logger.warning('Bot API call failed: %s', future.exception())
+
+
+def run_outbound_call(future, call):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(call())
+    except Exception as e:
+        future.set_exception(e)
+
+
+def chat_bucket(chat_id):
+    bucket = outbound_chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = outbound_chat_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+    return bucket
+
+
+def take_outbound(now):
+    """Pop the most urgent call allowed by its chat's limit, or return how long to wait for one"""
+    priority, seq, enqueued_at, chat_id, future, call = outbound_queue[0]
+    if chat_id is None or chat_bucket(chat_id).wait_time(now) == 0:
+        return heapq.heappop(outbound_queue), None
+
+    # The most urgent chat is out of tokens, it must not hold back the others
+    ready, wait = None, None
+    for i, item in enumerate(outbound_queue):
+        chat_wait = 0 if item[3] is None else chat_bucket(item[3]).wait_time(now)
+        if chat_wait == 0:
+            if ready is None or item < outbound_queue[ready]:
+                ready = i
+        elif wait is None or chat_wait < wait:
+            wait = chat_wait
+
+    if ready is None:
+        return None, wait
+    item = outbound_queue[ready]
+    outbound_queue[ready] = outbound_queue[-1]
+    outbound_queue.pop()
+    heapq.heapify(outbound_queue)
+    return item, None
+
+
+def run_outbound(executor):
+    while True:
+        sleep(outbound_global_bucket.wait_time(monotonic()))
+
+        with outbound_condition:
+            while True:
+                if outbound_queue:
+                    item, wait = take_outbound(monotonic())
+                    if item is not None:
+                        break
+                elif outbound_stopping:
+                    return
+                else:
+                    wait = None
+                outbound_condition.wait(wait)
+
+            priority, seq, enqueued_at, chat_id, future, call = item
+            outbound_global_bucket.take()
+            if chat_id is not None:
+                outbound_chat_buckets[chat_id].take()
+                if len(outbound_chat_buckets) > OUTBOUND_MAX_CHAT_BUCKETS:
+                    prune_chat_buckets(monotonic())
+
+        waited = monotonic() - enqueued_at
+        stats = outbound_stats[PRIORITY_NAMES[priority]]
+        stats['sent'] += 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+
+        executor.submit(run_outbound_call, future, call)
+
+
+def prune_chat_buckets(now):
+    """Forget the chats whose buckets are full again, a new bucket starts full anyway"""
+    for chat_id in [chat_id for chat_id, bucket in outbound_chat_buckets.items()
+                    if bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity]:
+        del outbound_chat_buckets[chat_id]
+
+
+def outbound_queue_depth():
+    with outbound_condition:
+        return len(outbound_queue)
+
+
+def start_outbound_scheduler():
+    global outbound_worker, outbound_executor, outbound_global_bucket
+    outbound_global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+    outbound_executor = ThreadPoolExecutor(OUTBOUND_SEND_WORKERS, thread_name_prefix='outbound')
+    outbound_worker = threading.Thread(target=run_outbound, args=(outbound_executor,), name='outbound', daemon=True)
+    outbound_worker.start()
+
+
+def stop_outbound_scheduler():
+    """Send what is still queued and stop"""
+    global outbound_stopping
+    with outbound_condition:
+        outbound_stopping = True
+        outbound_condition.notify()
+    outbound_worker.join(timeout=30)
+    outbound_executor.shutdown(wait=True)
+    for name, stats in outbound_stats.items():
+        if stats['sent']:
+            logger.info('Outbound %s calls: %s, average wait %.3fs, max wait %.3fs', name, stats['sent'],
+                        stats['wait_total'] / stats['sent'], stats['wait_max'])
+
+
+def delete_messages(bot, chat_id, message_ids):
+    """Delete up to DELETE_BATCH_SIZE messages of one chat with a single call"""
+    for attempt in range(DELETE_MAX_ATTEMPTS):
+        try:
+            # Not wrapped by this python-telegram-bot version
+            send(PRIORITY_CLEANUP, None, bot._request.post, '{}/deleteMessages'.format(bot.base_url),
+                 {'chat_id': chat_id, 'message_ids': message_ids}).result()
+            return
+        except RetryAfter as e:
+            sleep(e.retry_after)
+        except BadRequest as e:
+            # Messages already gone or too old to delete, retrying won't help
+            logger.debug('Could not delete messages %s in chat %s: %s', message_ids, chat_id, e)
+            return
+        except NetworkError:
+            sleep(2 ** attempt)
+    logger.warning('Gave up deleting messages %s in chat %s', message_ids, chat_id)
+
+
+def run_deletions(bot):
+    stopping = False
+    while not stopping:
+        batch = [deletion_queue.get()]
+        # Everything queued meanwhile goes out in the same calls
+        while True:
+            try:
+                batch.append(deletion_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        by_chat = OrderedDict()
+        for item in batch:
+            if item is None:
+                stopping = True
+                continue
+            chat_id, message_ids = item
+            # Sessions of a shared captcha restored as overdue all carry its photo
+            by_chat.setdefault(chat_id, OrderedDict()).update(OrderedDict.fromkeys(message_ids))
+
+        for chat_id, message_ids in by_chat.items():
+            message_ids = list(message_ids)
+            for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                try:
+                    delete_messages(bot, chat_id, message_ids[i:i + DELETE_BATCH_SIZE])
+                except TelegramError as e:
+                    logger.warning('Could not delete messages in chat %s: %s', chat_id, e)
+
+
+def start_deletion_worker(bot):
+    global deletion_worker
+    deletion_worker = threading.Thread(target=run_deletions, args=(bot,), name='deletions', daemon=True)
+    deletion_worker.start()
+
+
+def stop_deletion_worker():
+    deletion_queue.put(None)
+    deletion_worker.join(timeout=30)
+
+
+def build_trigger_matcher(words):
+    """Compile all trigger words into one whole-word, case-insensitive search"""
+    # Longer words first, so a word is never shadowed by its own prefix
+    alternation = '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+    return re.compile(r'(?:^|[^\w])(?:{})(?:[^\w]|$)'.format(alternation), flags=re.IGNORECASE).search
+
+
+DEFAULT_TRIGGER_MATCHER = build_trigger_matcher(DEFAULT_ADMIN_TRIGGERS)
+
+
+def make_chat_settings(registered, captcha_time, welcome_message, goodbye_message, admin_triggers):
+    """ChatSettings from stored values, None stands for the default"""
+    return ChatSettings(
+        bool(registered),
+        DEFAULT_CAPTCHA_TIME if captcha_time is None else captcha_time,
+        DEFAULT_WELCOME_MESSAGE if welcome_message is None else welcome_message,
+        DEFAULT_GOODBYE_MESSAGE if goodbye_message is None else goodbye_message,
+        None if admin_triggers is None else tuple(admin_triggers),
+        DEFAULT_TRIGGER_MATCHER if admin_triggers is None else build_trigger_matcher(admin_triggers))
+
+
+DEFAULT_CHAT_SETTINGS = make_chat_settings(False, None, None, None, None)
+
+
+def get_chat_settings(chat_id):
+    """Settings of the chat in the current snapshot, the defaults for an unknown chat"""
+    return chat_settings.get(chat_id, DEFAULT_CHAT_SETTINGS)
+
+
+def is_registered(chat_id):
+    return get_chat_settings(chat_id).registered
+
+
+def update_chat_settings(chat_id, **changes):
+    """Publish a new snapshot with the chat's settings changed and save that chat, returns its new settings"""
+    global chat_settings
+    if 'admin_triggers' in changes:
+        triggers = changes['admin_triggers']
+        changes['match_trigger'] = DEFAULT_TRIGGER_MATCHER if triggers is None else build_trigger_matcher(triggers)
+    with chat_settings_lock:
+        settings = get_chat_settings(chat_id)._replace(**changes)
+        snapshot = dict(chat_settings)
+        snapshot[chat_id] = settings
+        chat_settings = snapshot
+        # Under the lock, so the store gets the changes of a chat in the same order
+        save_chat_config(chat_id, settings)
+    return settings
+
+
+def filter_update(update, context):
+    """Drop duplicate and excess updates before any other handler sees them"""
+    log_context.update_id = update.update_id
+    log_context.chat_id = update.effective_chat.id if update.effective_chat else None
+    log_context.user_id = update.effective_user.id if update.effective_user else None
+    reason = drop_reason(update, time())
+    if reason is not None:
+        count('bot_updates_dropped_total', reason=reason)
+        raise DispatcherHandlerStop
+
+
+def drop_reason(update, now):
+    with ingest_lock:
+        # Telegram sends the updates again whose offset was not confirmed before a reconnect
+        if update.update_id in seen_update_ids:
+            return 'duplicate'
+        seen_update_ids.add(update.update_id)
+        seen_update_order.append(update.update_id)
+        if len(seen_update_order) > UPDATE_DEDUP_WINDOW:
+            seen_update_ids.discard(seen_update_order.popleft())
+
+    message = update.message
+    # Joins have their own limits, see record_join
+    if message is not None and (message.new_chat_members or message.left_chat_member):
+        return None
+    user, chat = update.effective_user, update.effective_chat
+    if user is None or chat is None:
+        return None
+
+    key = chat.id, user.id
+    with ingest_lock:
+        times = flood_windows.get(key)
+        if times is None:
+            times = flood_windows[key] = deque(maxlen=FLOOD_MESSAGES)
+            if len(flood_windows) > FLOOD_MAX_USERS:
+                flood_windows.popitem(last=False)
+        else:
+            flood_windows.move_to_end(key)
+        # Only accepted messages count, a flooding user gets FLOOD_MESSAGES per FLOOD_WINDOW through
+        if len(times) == FLOOD_MESSAGES and now - times[0] < FLOOD_WINDOW:
+            return 'flood'
+        times.append(now)
+
+    if message is not None and message.text is not None and message.text.isdigit():
+        session = get_session(chat.id, user.id)
+        if session is not None and session.attempts >= CAPTCHA_MAX_ATTEMPTS:
+            return 'attempts'
+    return None
+
+
+@timed
 def process_message(update, context):
-    logger.debug('process_message %s', update)
+    logger.debug('process_message')
 
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
+    if not is_registered(update.message.chat_id):
         return
 
     chat_id = update.message.chat_id
     if update.message.text is not None:
         if update.message.text.isdigit():
-            username = update.message.from_user.username
-            if username in captchas[chat_id]:
-                if captchas[chat_id][username] == update.message.text.casefold():
-                    messages_to_delete[chat_id][username].append(update.message.message_id)
+            session = get_session(chat_id, update.message.from_user.id)
+            if session is None and not sessions_restored.is_set():
+                session = load_session(chat_id, update.message.from_user.id)
+            if session is not None:
+                if code_matches(session.code_hash, update.message.text):
+                    session.message_ids.append(update.message.message_id)
                     complete_captcha(context, update)
                 else:
-                    message = update.message.reply_text('Неверно. Попробуйте ещё раз.')
-                    messages_to_delete[chat_id][username].append(update.message.message_id)
-                    messages_to_delete[chat_id][username].append(message.message_id)
-        elif find_whole_word('@admin')(update.message.text) is not None:
+                    session.attempts += 1
+                    count('bot_captchas_total', result='failed')
+                    session.message_ids.append(update.message.message_id)
+                    save_session(session)
+                    keep_session_message(session, send(PRIORITY_REPLY, chat_id, update.message.reply_text,
+                                                       'Неверно. Попробуйте ещё раз.'))
+        elif get_chat_settings(chat_id).match_trigger(update.message.text) is not None:
             notify_admins(update, context)
 
 
 def notify_admins(update, context):
-    admins = context.bot.get_chat_administrators(update.message.chat_id)
+    admins = get_chat_admins(context.bot, update.message.chat_id).admins
     admin_text = ", ".join('@' + admin.user.username for admin in admins if not admin.user.is_bot)
 
-    update.message.reply_text(admin_text)
+    send_later(PRIORITY_REPLY, update.message.chat_id, update.message.reply_text, admin_text)
 
 
 def complete_captcha(context, update):
+    count('bot_captchas_total', result='solved')
     chat_id = update.message.chat_id
     username = update.message.from_user.username
-    update.message.reply_text(f"""@{username}, {WELCOME_MESSAGE[chat_id]}""")
-    stop_job(context, update.message.from_user.id)
-    cleanup(chat_id, username, context)
+    send_later(PRIORITY_REPLY, chat_id, update.message.reply_text, f"""@{username}, {get_chat_settings(chat_id).welcome_message}""")
+    cleanup(chat_id, update.message.from_user.id, context)
+
+
+def render_captcha():
+    """Render a new captcha in memory, returns (code, png bytes, seconds it took)"""
+    global captcha_renderer
+    started = monotonic()
+    with captcha_renderer_lock:
+        if captcha_renderer is None:
+            # The font is loaded once per process, every render draws a fresh code from the source
+            captcha_renderer = Claptcha(random_digit_string, CAPTCHA_FONT)
+        code, image = captcha_renderer.bytes
+    return code, image.getvalue(), monotonic() - started
+
+
+def render_fallback_captcha():
+    """A smaller captcha without resampling, several times cheaper to render"""
+    global captcha_fallback_renderer
+    started = monotonic()
+    with captcha_fallback_lock:
+        if captcha_fallback_renderer is None:
+            captcha_fallback_renderer = Claptcha(random_digit_string, CAPTCHA_FONT, size=CAPTCHA_FALLBACK_SIZE,
+                                                 resample=Image.NEAREST)
+        code, image = captcha_fallback_renderer.bytes
+    observe('bot_captcha_render_seconds', monotonic() - started, renderer='fallback')
+    return code, image.getvalue()
+
+
+def submit_render():
+    """Start a render in the pool, None while CAPTCHA_RENDER_QUEUE renders are already waiting"""
+    if not captcha_render_slots.acquire(blocking=False):
+        return None
+    try:
+        future = captcha_render_pool.submit(render_captcha)
+    except Exception:
+        captcha_render_slots.release()
+        raise
+    future.add_done_callback(lambda future: captcha_render_slots.release())
+    return future
+
+
+def rendered(future, timeout=None):
+    code, image, seconds = future.result(timeout)
+    observe('bot_captcha_render_seconds', seconds, renderer='pool')
+    return code, image
 
 
-def create_captcha(text):
-    c = Claptcha(text, "FreeMono.ttf")
-    c.write("last_captcha.png")
-    return open('last_captcha.png', 'rb')
+def create_captcha():
+    """Take a ready captcha from the pool, or render one, a cheaper one when the renderers are overloaded"""
+    try:
+        return captcha_pool.get_nowait()
+    except queue.Empty:
+        pass
+
+    logger.debug('captcha pool is empty, rendering in place')
+    started = monotonic()
+    try:
+        future = submit_render()
+        if future is not None:
+            captcha = rendered(future, CAPTCHA_RENDER_TIMEOUT)
+            observe('bot_captcha_wait_seconds', monotonic() - started)
+            return captcha
+        reason = 'overload'
+    except FutureTimeoutError:
+        reason = 'timeout'
+    except Exception as e:
+        logger.warning('Captcha rendering failed: %s', e)
+        reason = 'error'
+    count('bot_captcha_fallbacks_total', reason=reason)
+    return render_fallback_captcha()
+
+
+def fill_captcha_pool():
+    # One render per renderer in flight, the others are left to the handlers
+    in_flight = deque()
+    while True:
+        try:
+            while len(in_flight) < max(CAPTCHA_RENDER_PROCESSES, 1):
+                future = submit_render()
+                if future is None:
+                    break
+                in_flight.append(future)
+            if not in_flight:
+                sleep(0.1)
+                continue
+            # Blocks while the pool is full
+            captcha_pool.put(rendered(in_flight.popleft()))
+        except Exception as e:
+            if captcha_render_stopping:
+                return
+            if isinstance(e, BrokenProcessPool):
+                # A renderer was killed, e.g. by the OOM killer, which leaves the whole pool unusable
+                logger.warning('A captcha renderer died, starting new ones')
+                in_flight.clear()
+                old_pool = captcha_render_pool
+                start_render_pool()
+                old_pool.shutdown(wait=False)
+                continue
+            logger.warning('Captcha rendering failed: %s', e)
+            sleep(1)
+
+
+def start_render_pool():
+    global captcha_render_pool
+    if CAPTCHA_RENDER_PROCESSES:
+        captcha_render_pool = ProcessPoolExecutor(CAPTCHA_RENDER_PROCESSES)
+    else:
+        captcha_render_pool = ThreadPoolExecutor(1, thread_name_prefix='captcha_render')
+
+
+def start_captcha_pool():
+    global captcha_render_stopping
+    captcha_render_stopping = False
+    start_render_pool()
+    threading.Thread(target=fill_captcha_pool, name='captcha_pool', daemon=True).start()
+
+
+def stop_captcha_pool():
+    global captcha_render_stopping
+    captcha_render_stopping = True
+    captcha_render_pool.shutdown(wait=False)
 
 
 def error(update, context):
     """Log Errors caused by Updates."""
-    logger.warning('Update "%s" caused error "%s"', update, context.error)
+    # The update itself is in the record's update_id, chat_id and user_id
+    logger.warning('Update caused error "%s"', context.error)
 
 
+@timed
 def new_chat_members_invite(update, context):
-    logger.debug('new_chat_members_invite %s', update)
+    logger.debug('new_chat_members_invite')
     chat_id = update.message.chat_id
-    if chat_id not in INSTANCE_CHAT_ID:
+    if not is_registered(chat_id):
         return
 
-    if chat_id not in captchas:
-        captchas[chat_id] = {}
-    if chat_id not in messages_to_delete:
-        messages_to_delete[chat_id] = {}
-
     for user in update.message.new_chat_members:
-        if not user.is_bot and user.username not in captchas[chat_id]:
-            start_new_captcha(context, user, update)
+        if not user.is_bot:
+            remember_join(chat_id, user, time())
+        if not user.is_bot and get_session(chat_id, user.id) is None:
+            if record_join(context.bot, chat_id, time()):
+                queue_raid_captcha(context, chat_id, user)
+            else:
+                start_new_captcha(context, user, update)
+
+
+def record_join(bot, chat_id, now):
+    """Count a join in the sliding window of the chat, returns whether the chat is in a raid"""
+    with raid_lock:
+        times = join_times.get(chat_id)
+        if times is None:
+            times = join_times[chat_id] = deque(maxlen=RAID_JOINS)
+        times.append(now)
+        raiding = raid_until.get(chat_id, 0) > now
+        burst = len(times) == RAID_JOINS and now - times[0] <= RAID_WINDOW
+        if burst:
+            raid_until[chat_id] = now + RAID_COOLDOWN
+
+    if burst and not raiding:
+        logger.warning('Join raid in chat %s, switching to shared captchas', chat_id)
+        count('bot_raids_total')
+        if RAID_RESTRICT:
+            restrict_chat(bot, chat_id)
+    return raiding or burst
+
+
+def restrict_chat(bot, chat_id):
+    with raid_lock:
+        if chat_id in raid_restrictions:
+            # Still restricted by an earlier raid, the chat's permissions now are the raid's
+            return
+    send(PRIORITY_KICK, None, bot.get_chat, chat_id).add_done_callback(partial(restrict_fetched_chat, bot, chat_id))
+
+
+def restrict_fetched_chat(bot, chat_id, chat):
+    if chat.exception() is not None:
+        logger.warning('Could not restrict chat %s: %s', chat_id, chat.exception())
+        return
+    permissions = chat.result().permissions
+    with raid_lock:
+        raid_restrictions.setdefault(chat_id, permissions.to_dict() if permissions is not None else {})
+    save_raid_restrictions()
+    send_later(PRIORITY_KICK, None, bot.set_chat_permissions, chat_id, ChatPermissions(**RAID_PERMISSIONS))
+
+
+def save_raid_restrictions():
+    with raid_lock:
+        restrictions = list(raid_restrictions.items())
+    save_setting('raid_restrictions', restrictions)
+
+
+def end_raids_job(context):
+    """Leave the raid mode of the calmed down chats and give them their permissions back"""
+    now = time()
+    with raid_lock:
+        ended = [chat_id for chat_id, until in raid_until.items() if until <= now]
+        for chat_id in ended:
+            del raid_until[chat_id]
+        lifted = [(chat_id, permissions) for chat_id, permissions in raid_restrictions.items()
+                  if chat_id not in raid_until]
+        for chat_id, permissions in lifted:
+            del raid_restrictions[chat_id]
+
+    for chat_id in ended:
+        logger.info('Join raid in chat %s is over', chat_id)
+    for chat_id, permissions in lifted:
+        send_later(PRIORITY_KICK, None, context.bot.set_chat_permissions, chat_id, ChatPermissions(**permissions))
+    if lifted:
+        save_raid_restrictions()
+
+
+def queue_raid_captcha(context, chat_id, user):
+    with raid_lock:
+        batch = raid_batches.setdefault(chat_id, [])
+        batch.append(user)
+        if len(batch) == 1:
+            raid_batch_jobs[chat_id] = context.job_queue.run_once(raid_batch_job, RAID_BATCH_DELAY,
+                                                                  context=chat_id)
+        full = len(batch) >= RAID_BATCH_SIZE
+    if full:
+        start_raid_captcha(context.bot, chat_id)
+
+
+def raid_batch_job(context):
+    start_raid_captcha(context.bot, context.job.context)
+
+
+def start_raid_captcha(bot, chat_id):
+    """Take the chat's batch and post its captcha from a thread of its own
+
+    Rendering and the chat's rate limit would otherwise hold up the handlers or the job queue."""
+    with raid_lock:
+        users = raid_batches.pop(chat_id, [])
+        job = raid_batch_jobs.pop(chat_id, None)
+    if job is not None:
+        # A batch flushed for its size must not have the next one posted early
+        job.schedule_removal()
+    if users:
+        threading.Thread(target=issue_raid_captcha, args=(bot, chat_id, users), name='raid_captcha',
+                         daemon=True).start()
+
+
+@timed
+def issue_raid_captcha(bot, chat_id, users):
+    """Post one captcha for a batch of users, each of them gets a session for it once it's sent"""
+    generated_captcha, image = create_captcha()
+    due = get_chat_settings(chat_id).captcha_time
+    mentions = ', '.join('@' + user.username if user.username else user.first_name for user in users)
+    photo = send(PRIORITY_CAPTCHA, chat_id, bot.send_photo, chat_id, BytesIO(image),
+                 caption=f'{mentions}, у вас есть {due} секунд, '
+                         f'чтобы написать то что вы видите на картинке')
+    photo.add_done_callback(partial(add_raid_sessions, chat_id, users, hash_code(generated_captcha), due))
+
+
+def add_raid_sessions(chat_id, users, code_hash, due, photo):
+    if photo.exception() is not None:
+        logger.warning('Could not send the shared captcha to chat %s: %s', chat_id, photo.exception())
+        return
+
+    # One deadline for the whole batch, they expire in the same tick
+    deadline = time() + due
+    for user in users:
+        session = CaptchaSession(chat_id, user.id, user.username, code_hash, deadline,
+                                 message_ids=(photo.result().message_id,))
+        add_session(session)
+        save_session(session)
+    count('bot_captchas_total', len(users), result='issued')
+    count('bot_shared_captchas_total')
 
 
 def start_new_captcha(context, user, update):
-    generated_captcha = random_digit_string()
+    generated_captcha, image = create_captcha()
     user_id = user.id
     chat_id = update.message.chat_id
     username = user.username
-    captchas[chat_id][username] = generated_captcha.casefold()
-    photo = update.message.reply_photo(create_captcha(generated_captcha),
-                                       caption=f'@{username}, у вас есть {CAPTCHA_TIME[chat_id]} секунд, '
-                                               f'чтобы написать то что вы видите на картинке')
-    messages_to_delete[chat_id][username] = list()
-    messages_to_delete[chat_id][username].append(photo.message_id)
-    due = CAPTCHA_TIME[chat_id]
-
-    stop_job(context, user_id)
-    start_job(chat_id, context, due, user_id, username)
-
-
-def get_job_name(user_id):
-    return 'job' + str(user_id)
-
-
-def start_job(chat_id, context, due, user_id, username):
-    new_job = context.job_queue.run_once(kick_on_time, due, context=(chat_id, username, user_id))
-    context.chat_data[get_job_name(user_id)] = new_job
-    save_jobs_job(context)
-
-
-def stop_job(context, user_id):
-    job_name = get_job_name(user_id)
-    if job_name in context.chat_data:
-        old_job = context.chat_data[job_name]
-        old_job.schedule_removal()
-    save_jobs_job(context)
+    due = get_chat_settings(chat_id).captcha_time
+    session = CaptchaSession(chat_id, user_id, username, hash_code(generated_captcha), time() + due)
+    add_session(session)
+    save_session(session)
+    count('bot_captchas_total', result='issued')
+    keep_session_message(session, send(PRIORITY_CAPTCHA, chat_id, update.message.reply_photo, BytesIO(image),
+                                       caption=f'@{username}, у вас есть {due} секунд, '
+                                               f'чтобы написать то что вы видите на картинке'))
 
 
+@timed
 def left_chat_member(update, context):
-    logger.info('left_chat_member %s', update)
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
+    logger.info('left_chat_member %s', update.message.left_chat_member.id)
+    if not is_registered(update.message.chat_id):
         return
 
     username = update.message.left_chat_member.username
     chat_id = update.message.chat_id
 
-    update.message.reply_text(f"""@{username}, {GOODBYE_MESSAGE[chat_id]}""")
+    with admin_cache_lock:
+        entry = admin_cache.get(chat_id)
+    if entry is not None and update.message.left_chat_member.id in entry.user_ids:
+        invalidate_chat_admins(chat_id)
+
+    send_later(PRIORITY_REPLY, chat_id, update.message.reply_text, f"""@{username}, {get_chat_settings(chat_id).goodbye_message}""")
 
-    stop_job(context, update.message.left_chat_member.id)
-    cleanup(chat_id, username, context)
+    cleanup(chat_id, update.message.left_chat_member.id, context)
 
 
+@timed
 def show_help_message(update, context):
-    logger.debug('help %s', update)
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
+    logger.debug('help')
+    if not is_registered(update.message.chat_id):
         return
 
     if not user_is_admin(update, context):
@@ -227,6 +1484,7 @@ def show_help_message(update, context):
                 "/set_welcome_msg <сообщение> -- устанавливает сообщение, которое пользователь видит перед каптчей\n" \
                 "/set_goodbye_msg <сообщение> -- сообщение, которое остаётся после того как пользователь вышел\n" \
                 "/set_captcha_time <секунды> -- устанавливает время отведенное на ввод каптчи\n" \
+                "/set_admin_triggers <слово> ... -- слова, по которым бот зовёт админов\n" \
                 "Комманды, работающие в ответ на сообщения пользователей:\n" \
                 "/kick -- удаляет этого пользователя из чата\n" \
                 "/ban -- банит пользователя навсегда в чате\n" \
@@ -234,10 +1492,10 @@ def show_help_message(update, context):
     update.message.reply_text(help_text)
 
 
+@timed
 def set_welcome_message(update, context):
-    global WELCOME_MESSAGE
-    logger.debug('set_welcome_message %s', update)
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
+    logger.debug('set_welcome_message')
+    if not is_registered(update.message.chat_id):
         return
 
     if not user_is_admin(update, context):
@@ -245,15 +1503,14 @@ def set_welcome_message(update, context):
 
     chat_id = update.message.chat_id
     msg = update.message.text.split(None, 1)[1]
-    WELCOME_MESSAGE[chat_id] = msg
+    update_chat_settings(chat_id, welcome_message=msg)
     update.message.reply_text("Приветственное сообщение установлено!")
-    save_config_data()
 
 
+@timed
 def set_goodbye_message(update, context):
-    global GOODBYE_MESSAGE
-    logger.debug('set_goodbye_message %s', update)
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
+    logger.debug('set_goodbye_message')
+    if not is_registered(update.message.chat_id):
         return
 
     if not user_is_admin(update, context):
@@ -261,15 +1518,14 @@ def set_goodbye_message(update, context):
 
     chat_id = update.message.chat_id
     msg = update.message.text.split(None, 1)[1]
-    GOODBYE_MESSAGE[chat_id] = msg
+    update_chat_settings(chat_id, goodbye_message=msg)
     update.message.reply_text("Прощальное сообщение установлено!")
-    save_config_data()
 
 
+@timed
 def set_captcha_time(update, context):
-    global CAPTCHA_TIME
-    logger.debug('set_captcha_time %s', update)
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
+    logger.debug('set_captcha_time')
+    if not is_registered(update.message.chat_id):
         return
 
     if not user_is_admin(update, context):
@@ -281,83 +1537,269 @@ def set_captcha_time(update, context):
             update.message.reply_text('Время не может быть отрицательным!')
             return
 
-        CAPTCHA_TIME[update.message.chat_id] = due
+        update_chat_settings(update.message.chat_id, captcha_time=due)
         update.message.reply_text("Время на решение каптчи установлено на " + str(due) + " секунд")
-        save_config_data()
     except (IndexError, ValueError):
         update.message.reply_text('Использование: /set_captcha_time <seconds>')
 
 
-def user_is_admin(update, context):
-    members = context.bot.get_chat_administrators(update.message.chat_id)
-    return any(member for member in members if member.user.username == update.message.from_user.username)
-
-
-def kick_user(update, context):
-    logger.debug('kick_user %s', update)
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
+@timed
+def set_admin_triggers(update, context):
+    logger.debug('set_admin_triggers')
+    if not is_registered(update.message.chat_id):
         return
 
     if not user_is_admin(update, context):
         return
 
-    if update.message.reply_to_message is None:
-        update.message.reply_text('Использование: /kick, в ответе на сообщение')
-    else:
-        chat_id = update.message.chat_id
-        username = update.message.reply_to_message.from_user.username
-        if context.bot.kick_chat_member(chat_id, update.message.reply_to_message.from_user.id,
-                                        until_date=datetime.utcnow() + timedelta(minutes=1)):
-            update.message.reply_text("@" + username + ", " + GOODBYE_MESSAGE[chat_id])
+    if not context.args:
+        update.message.reply_text('Использование: /set_admin_triggers <слово> ..., например, /set_admin_triggers @admin')
+        return
+
+    chat_id = update.message.chat_id
+    settings = update_chat_settings(chat_id, admin_triggers=tuple(context.args))
+    update.message.reply_text("Слова для вызова админов: " + ", ".join(settings.admin_triggers))
+
+
+def has_role(chat_id, user):
+    """Whether the user is in the ACL of the chat, resolves a pending username on the way"""
+    acl = acls.get(chat_id)
+    if acl is None:
+        return False
+    if acl.members.get(user.id, False) == user.username:
+        return True
+
+    if user.id in acl.members or (user.username and user.username.lower() in acl.pending):
+        # Seen for the first time or under a new username
+        with acl_lock:
+            acl.add(user.id, user.username)
+        logger.info('ACL of %s: user %s is @%s', chat_id, user.id, user.username)
+        save_acl()
+        return True
+    return False
+
+
+def is_bot_admin(user):
+    return user.username == SUPER_ADMIN or has_role(None, user)
+
+
+def acl_rows():
+    """The ACL as (chat_id, user_id, username) rows, pending usernames have no user_id"""
+    with acl_lock:
+        rows = []
+        for chat_id, acl in acls.items():
+            rows.extend([chat_id, user_id, username] for user_id, username in acl.members.items())
+            rows.extend([chat_id, None, username] for username in acl.pending)
+    return rows
+
+
+def load_acl(rows):
+    global acls
+    loaded = {}
+    for chat_id, user_id, username in rows:
+        acl = loaded.setdefault(chat_id, Acl())
+        if user_id is None:
+            acl.add_name(username)
+        else:
+            acl.add(user_id, username)
+    with acl_lock:
+        acls = loaded
 
 
-def ban_user(update, context):
-    logger.debug('ban_user %s', update)
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
+def user_is_admin(update, context):
+    chat_id = update.message.chat_id
+    user_id = update.message.from_user.id
+    if has_role(chat_id, update.message.from_user):
+        return True
+
+    entry = get_chat_admins(context.bot, chat_id)
+    if user_id in entry.user_ids:
+        return True
+
+    # The user may have been promoted after the list was cached
+    if time() - entry.fetched_at > ADMIN_CACHE_RECHECK:
+        return user_id in refresh_chat_admins(context.bot, chat_id).user_ids
+    return False
+
+
+def get_chat_admins(bot, chat_id):
+    with admin_cache_lock:
+        entry = admin_cache.get(chat_id)
+        if entry is not None and time() - entry.fetched_at < ADMIN_CACHE_TTL:
+            admin_cache.move_to_end(chat_id)
+            return entry
+
+    return refresh_chat_admins(bot, chat_id)
+
+
+def refresh_chat_admins(bot, chat_id):
+    admins = bot.get_chat_administrators(chat_id)
+    entry = AdminCacheEntry(time(), admins, frozenset(admin.user.id for admin in admins))
+    with admin_cache_lock:
+        admin_cache[chat_id] = entry
+        admin_cache.move_to_end(chat_id)
+        while len(admin_cache) > ADMIN_CACHE_SIZE:
+            admin_cache.popitem(last=False)
+    return entry
+
+
+def invalidate_chat_admins(chat_id):
+    with admin_cache_lock:
+        admin_cache.pop(chat_id, None)
+
+
+def refresh_admin_cache_job(context):
+    """Refresh cached admin lists shortly before they expire"""
+    expires_soon = time() - (ADMIN_CACHE_TTL - ADMIN_CACHE_REFRESH_AHEAD)
+    with admin_cache_lock:
+        chat_ids = [chat_id for chat_id, entry in admin_cache.items()
+                    if is_registered(chat_id) and entry.fetched_at < expires_soon]
+
+    for chat_id in chat_ids:
+        try:
+            refresh_chat_admins(context.bot, chat_id)
+        except TelegramError as e:
+            logger.warning('Could not refresh admins of chat %s: %s', chat_id, e)
+
+
+def remember_join(chat_id, user, now):
+    with recent_joins_lock:
+        joins = recent_joins.get(chat_id)
+        if joins is None:
+            joins = recent_joins[chat_id] = deque(maxlen=RECENT_JOINS)
+        joins.append((now, user.id, user.username))
+
+
+def moderation_targets(update, args):
+    """Users a moderation command is about as {user_id: username}, and the @usernames nobody is known by
+
+    Targets are the author of the replied message, mentions of users without a username, user ids, @usernames
+    of recent joiners and, for +<time>, everybody who joined within that time."""
+    chat_id = update.message.chat_id
+    targets = OrderedDict()
+    unknown = []
+    reply = update.message.reply_to_message
+    if reply is not None:
+        targets[reply.from_user.id] = reply.from_user.username
+    for entity in update.message.entities:
+        if entity.type == MessageEntity.TEXT_MENTION:
+            targets[entity.user.id] = entity.user.username
+
+    with recent_joins_lock:
+        joins = list(recent_joins.get(chat_id, ()))
+    ids_by_name = {username.lower(): user_id for joined_at, user_id, username in joins if username}
+    for arg in args:
+        if arg.startswith('+'):
+            since = time() - parse_time(arg[1:]).total_seconds()
+            targets.update((user_id, username) for joined_at, user_id, username in joins if joined_at >= since)
+        elif arg.isdigit():
+            targets.setdefault(int(arg), None)
+        elif arg.startswith('@'):
+            user_id = ids_by_name.get(arg[1:].lower())
+            if user_id is None:
+                unknown.append(arg)
+            else:
+                targets[user_id] = arg[1:]
+    # Admins don't act on themselves by accident
+    targets.pop(update.message.from_user.id, None)
+    return targets, unknown
+
+
+def moderate(update, context, action, args, usage, summarize, call, **kwargs):
+    """Run call on all targets of a moderation command at once, then summarize(update, names done, other lines)
+
+    The calls go through the outbound scheduler and the summary is sent from their done-callbacks, the handler
+    doesn't wait for the rate limits."""
+    chat_id = update.message.chat_id
+    if not is_registered(chat_id):
         return
 
     if not user_is_admin(update, context):
         return
 
-    if update.message.reply_to_message is None:
-        update.message.reply_text('Использование: /mute, в ответе на сообщение')
-    else:
-        chat_id = update.message.chat_id
-        username = update.message.reply_to_message.from_user.username
-        if context.bot.kick_chat_member(chat_id, update.message.reply_to_message.from_user.id):
-            update.message.reply_text("@" + username + ", " + GOODBYE_MESSAGE[chat_id])
+    targets, unknown = moderation_targets(update, args)
+    if not targets and not unknown:
+        update.message.reply_text(usage)
+        return
 
+    names = [('@' + username if username else str(user_id), user_id) for user_id, username in targets.items()]
+    acted_on = names[:MODERATION_MAX_TARGETS]
+    errors = [None] * len(acted_on)
+    pending = [len(acted_on)]
+    pending_lock = threading.Lock()
 
-def mute_user(update, context):
-    logger.debug('mute_user %s', update)
-    if update.message.chat_id not in INSTANCE_CHAT_ID:
-        return
+    def finish():
+        done = [name for (name, user_id), e in zip(acted_on, errors) if e is None]
+        failed = ['{} ({})'.format(name, e) for (name, user_id), e in zip(acted_on, errors) if e is not None]
+        count('bot_moderation_total', len(done), action=action, result='done')
+        count('bot_moderation_total', len(failed), action=action, result='failed')
 
-    if not user_is_admin(update, context):
+        rest = []
+        if failed:
+            rest.append('Не удалось: ' + ', '.join(failed))
+        if unknown:
+            rest.append('Не найдены: ' + ', '.join(unknown))
+        if len(names) > MODERATION_MAX_TARGETS:
+            rest.append('Пропущено сверх лимита: {}'.format(len(names) - MODERATION_MAX_TARGETS))
+        summarize(update, done, rest)
+
+    def sent(index, future):
+        with pending_lock:
+            errors[index] = future.exception()
+            pending[0] -= 1
+            if pending[0]:
+                return
+        finish()
+
+    if not acted_on:
+        finish()
+    for index, (name, user_id) in enumerate(acted_on):
+        send(PRIORITY_KICK, None, call, chat_id, user_id, **kwargs).add_done_callback(partial(sent, index))
+
+
+def reply_summary(update, lines):
+    if lines:
+        send_later(PRIORITY_REPLY, update.message.chat_id, update.message.reply_text, '\n'.join(lines))
+
+
+def reply_goodbye(update, done, rest):
+    goodbye = [', '.join(done) + ", " + get_chat_settings(update.message.chat_id).goodbye_message] if done else []
+    reply_summary(update, goodbye + rest)
+
+
+def reply_muted(due, update, done, rest):
+    muted = ['Ограничены на {}: {}'.format(due, ', '.join(done))] if done else []
+    reply_summary(update, muted + rest)
+
+
+@timed
+def kick_user(update, context):
+    logger.debug('kick_user')
+    moderate(update, context, 'kick', context.args,
+             'Использование: /kick в ответе на сообщение или /kick @user 123456 +10m (все, кто вошёл за 10 минут)',
+             reply_goodbye, context.bot.kick_chat_member, until_date=datetime.utcnow() + timedelta(minutes=1))
+
+
+@timed
+def ban_user(update, context):
+    logger.debug('ban_user')
+    moderate(update, context, 'ban', context.args,
+             'Использование: /ban в ответе на сообщение или /ban @user 123456 +10m (все, кто вошёл за 10 минут)',
+             reply_goodbye, context.bot.kick_chat_member)
+
+
+@timed
+def mute_user(update, context):
+    logger.debug('mute_user')
+    usage = 'Использование: /mute <time>, например, /mute 6d5h4m3s в ответе на сообщение или /mute 2m @user 123456 +10m'
+    due = parse_time(context.args[0]) if context.args else None
+    if not due:
+        if is_registered(update.message.chat_id) and user_is_admin(update, context):
+            update.message.reply_text(usage)
         return
 
-    if update.message.reply_to_message is None:
-        update.message.reply_text('Использование: /mute <time>, в ответе на сообщение')
-    else:
-        try:
-            due = parse_time(context.args[0])
-            if due == timedelta():
-                raise ValueError
-
-            if context.bot.restrict_chat_member(update.message.chat_id, update.message.reply_to_message.from_user.id,
-                                                ChatPermissions(can_send_messages=False,
-                                                                can_add_web_page_previews=False,
-                                                                can_change_info=False,
-                                                                can_invite_users=False,
-                                                                can_pin_messages=False,
-                                                                can_send_media_messages=False,
-                                                                can_send_other_messages=False,
-                                                                can_send_polls=False),
-                                                until_date=datetime.utcnow() + due):
-                update.message.reply_text("Пользователь @" + update.message.reply_to_message.from_user.username +
-                                          " ограничен на " + str(due))
-        except (IndexError, ValueError):
-            update.message.reply_text('Использование: /mute <time>, например, /mute 6d5h4m3s или /mute 2m')
+    moderate(update, context, 'mute', context.args[1:], usage, partial(reply_muted, due),
+             context.bot.restrict_chat_member, permissions=MUTE_PERMISSIONS, until_date=datetime.utcnow() + due)
 
 
 def parse_time(time_str):
@@ -373,103 +1815,302 @@ def parse_time(time_str):
     return timedelta(**time_params)
 
 
-def load_jobs(jq):
-    logger.debug('load_jobs()')
-    with open(JOBS_PICKLE, 'rb') as fp:
-        while True:
-            try:
-                next_t, data, state = pickle.load(fp)
-            except EOFError:
-                break  # loaded all jobs
-
-            # New object with the same data
-            job = Job(**{var: val for var, val in zip(JOB_DATA, data)})
-
-            # Restore the state it had
-            for var, val in zip(JOB_STATE, state):
-                attribute = getattr(job, var)
-                getattr(attribute, 'set' if val else 'clear')()
-
-            job.job_queue = jq
-
-            next_t -= time()  # convert from absolute to relative time
+def open_store():
+    global store
+    first_run = not os.path.exists(STATE_DB)
+    store = sqlite3.connect(STATE_DB, check_same_thread=False)
+    # WAL keeps every commit a small append, and a crash mid-write only loses the open transaction
+    store.execute('PRAGMA journal_mode=WAL')
+    store.execute('PRAGMA synchronous=NORMAL')
+    version, = store.execute('PRAGMA user_version').fetchone()
+    if version > STORE_VERSION:
+        raise RuntimeError('{} has layout version {}, this version of the bot reads up to {}'.format(
+            STATE_DB, version, STORE_VERSION))
+    store.executescript(STORE_SCHEMA)
+    # Shards copy their part of an existing store instead
+    if first_run and STATE_DB == UNSHARDED_STATE_DB:
+        migrate_pickles()
+    if version < STORE_VERSION:
+        # A new store, it gets the layout of this version
+        with store_lock, store:
+            store.execute('PRAGMA user_version = {}'.format(STORE_VERSION))
 
-            jq._put(job, next_t)
 
+def close_store():
+    with store_lock:
+        store.close()
 
-def save_jobs(jq):
-    logger.debug('save_jobs()')
-    with jq._queue.mutex:  # in case job_queue makes a change
-        if jq:
-            job_tuples = jq._queue.queue
-        else:
-            job_tuples = []
-
-        with open(JOBS_PICKLE, 'wb') as fp:
-            for next_t, job in job_tuples:
 
-                # This job is always created at the start
-                if job.name == 'save_jobs_job':
-                    continue
+def chat_config_row(chat_id, settings):
+    triggers = settings.admin_triggers
+    return (chat_id, settings.registered, settings.captcha_time, settings.welcome_message, settings.goodbye_message,
+            None if triggers is None else json.dumps(triggers))
 
-                # Threading primitives are not pickleable
-                data = tuple(getattr(job, var) for var in JOB_DATA)
-                state = tuple(getattr(job, var).is_set() for var in JOB_STATE)
 
-                # Pickle the job
-                pickle.dump((next_t, data, state), fp)
+def save_chat_config(chat_id, settings):
+    logger.debug('save_chat_config(%s)', chat_id)
+    with store_lock, store:
+        store.execute('INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?)', chat_config_row(chat_id, settings))
 
 
-def save_jobs_job(context):
-    save_jobs(context.job_queue)
+def save_setting(key, value):
+    logger.debug('save_setting(%s)', key)
+    with store_lock, store:
+        store.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, json.dumps(value)))
 
 
-def save_temp_job(context):
-    save_temp_data()
-
-
-def save_temp_data():
-    logger.debug('save_temp_data()')
-    with open(TEMP_PICKLE, 'wb') as fp:
-        pickle.dump(captchas, fp)
-        pickle.dump(messages_to_delete, fp)
-
-
-def load_temp_data():
-    global captchas, messages_to_delete
-    logger.debug('load_temp_data()')
-    with open(TEMP_PICKLE, 'rb') as fp:
-        captchas = pickle.load(fp)
-        messages_to_delete = pickle.load(fp)
+def save_acl():
+    save_setting('acl', acl_rows())
 
 
 def save_config_data():
+    """Write the whole config at once, the handlers save only what they change"""
     logger.debug('save_config_data()')
-    with open(DATA_PICKLE, 'wb') as fp:
-        pickle.dump((CAPTCHA_TIME, GOODBYE_MESSAGE, WELCOME_MESSAGE, ADMINS), fp)
-        pickle.dump((PERSONAL_LINK_CHAT, PERSONAL_LINK_PROGRESSOR, PERSONAL_LINK_DATING, PERSONAL_LINK_VK), fp)
-        pickle.dump(INSTANCE_CHAT_ID, fp)
+    settings = {'acl': acl_rows(), 'link_chat': PERSONAL_LINK_CHAT, 'link_progressor': PERSONAL_LINK_PROGRESSOR,
+                'link_dating': PERSONAL_LINK_DATING, 'link_vk': PERSONAL_LINK_VK}
+    with store_lock, store:
+        store.executemany('INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?)',
+                          [chat_config_row(chat_id, settings) for chat_id, settings in chat_settings.items()])
+        store.executemany('INSERT OR REPLACE INTO settings VALUES (?, ?)',
+                          [(key, json.dumps(value)) for key, value in settings.items()])
 
 
 def load_config_data():
-    global CAPTCHA_TIME, GOODBYE_MESSAGE, WELCOME_MESSAGE, ADMINS
+    global chat_settings
     global PERSONAL_LINK_CHAT, PERSONAL_LINK_PROGRESSOR, PERSONAL_LINK_DATING, PERSONAL_LINK_VK
-    global INSTANCE_CHAT_ID
     logger.debug('load_config_data()')
-    with open(DATA_PICKLE, 'rb') as fp:
-        CAPTCHA_TIME, GOODBYE_MESSAGE, WELCOME_MESSAGE, ADMINS = pickle.load(fp)
-        PERSONAL_LINK_CHAT, PERSONAL_LINK_PROGRESSOR, PERSONAL_LINK_DATING, PERSONAL_LINK_VK = pickle.load(fp)
-        INSTANCE_CHAT_ID = pickle.load(fp)
+    with store_lock:
+        chats = store.execute('SELECT * FROM chats').fetchall()
+        settings = {key: json.loads(value) for key, value in store.execute('SELECT key, value FROM settings')}
+
+    snapshot = {}
+    for chat_id, registered, captcha_time, welcome_message, goodbye_message, admin_triggers in chats:
+        snapshot[chat_id] = make_chat_settings(registered, captcha_time, welcome_message, goodbye_message,
+                                               None if admin_triggers is None else json.loads(admin_triggers))
+    with chat_settings_lock:
+        chat_settings = snapshot
+
+    if 'acl' in settings:
+        load_acl(settings['acl'])
+    else:
+        # First run, the ADMINS usernames are pending until those users show up
+        load_acl([None, None, username] for username in ADMINS)
+    PERSONAL_LINK_CHAT = settings.get('link_chat', PERSONAL_LINK_CHAT)
+    PERSONAL_LINK_PROGRESSOR = settings.get('link_progressor', PERSONAL_LINK_PROGRESSOR)
+    PERSONAL_LINK_DATING = settings.get('link_dating', PERSONAL_LINK_DATING)
+    PERSONAL_LINK_VK = settings.get('link_vk', PERSONAL_LINK_VK)
+    invalidate_menus()
+
+    # Restrictions left by a raid during the last run are lifted by the next end_raids_job
+    with raid_lock:
+        raid_restrictions.update(settings.get('raid_restrictions', []))
+
+
+def mark_session(key, row):
+    global pending_sessions_first_change, pending_sessions_last_change, pending_sessions_changes
+    with pending_sessions_condition:
+        now = time()
+        if not pending_sessions_changes:
+            pending_sessions_first_change = now
+            pending_sessions_condition.notify()
+        pending_sessions_last_change = now
+        pending_sessions_changes += 1
+        pending_sessions[key] = row
+
+
+def save_session(session):
+    mark_session((session.chat_id, session.user_id),
+                 (session.chat_id, session.user_id, session.username, session.code_hash, session.deadline,
+                  session.attempts, session.message_ids.tobytes()))
+
+
+def delete_session(chat_id, user_id):
+    mark_session((chat_id, user_id), None)
+
+
+def flush_sessions():
+    """Write all pending session changes in one transaction"""
+    global pending_sessions, pending_sessions_changes
+    with pending_sessions_condition:
+        if not pending_sessions_changes:
+            return
+        changes, changed_sessions = pending_sessions_changes, pending_sessions
+        pending_sessions, pending_sessions_changes = {}, 0
+
+    changed_chats = len({chat_id for chat_id, user_id in changed_sessions})
+    logger.debug('flush_sessions() %s changes of %s sessions in %s chats', changes, len(changed_sessions),
+                 changed_chats)
+    with store_lock, store:
+        store.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          [row for row in changed_sessions.values() if row is not None])
+        store.executemany('DELETE FROM sessions WHERE chat_id = ? AND user_id = ?',
+                          [key for key, row in changed_sessions.items() if row is None])
+
+    sessions_flush_stats['flushes'] += 1
+    sessions_flush_stats['changes'] += changes
+    sessions_flush_stats['coalesced'] += changes - 1
+    sessions_flush_stats['chats'] += changed_chats
+
+
+def run_sessions_flusher():
+    """Flush once the changes settle down, without waking up while there are none"""
+    while True:
+        with pending_sessions_condition:
+            while True:
+                if pending_sessions_changes:
+                    wait = min(pending_sessions_last_change + SESSIONS_FLUSH_DELAY,
+                               pending_sessions_first_change + SESSIONS_FLUSH_MAX_DELAY) - time()
+                    if wait <= 0 or sessions_flusher_stopping:
+                        break
+                elif sessions_flusher_stopping:
+                    return
+                else:
+                    wait = None
+                pending_sessions_condition.wait(wait)
+        try:
+            flush_sessions()
+        except sqlite3.Error as e:
+            logger.error('Could not save the sessions: %s', e)
+
+
+def start_sessions_flusher():
+    global sessions_flusher, sessions_flusher_stopping
+    sessions_flusher_stopping = False
+    sessions_flusher = threading.Thread(target=run_sessions_flusher, name='sessions_flusher', daemon=True)
+    sessions_flusher.start()
+
+
+def stop_sessions_flusher():
+    global sessions_flusher_stopping
+    with pending_sessions_condition:
+        sessions_flusher_stopping = True
+        pending_sessions_condition.notify()
+    sessions_flusher.join(timeout=30)
+
+
+def expire_overdue_sessions(bot, now):
+    """Kick everybody whose captcha ran out while the bot was down, in one batch"""
+    with store_lock:
+        rows = store.execute('SELECT chat_id, user_id, message_ids FROM sessions WHERE deadline <= ?',
+                             (now,)).fetchall()
+    expired = 0
+    for chat_id, user_id, message_ids in rows:
+        with sessions_lock:
+            if (chat_id, user_id) in sessions_touched:
+                continue
+        # Behind everything the running chats are waiting for
+        send_later(PRIORITY_CLEANUP, None, bot.kick_chat_member, chat_id, user_id,
+                   until_date=datetime.utcnow() + timedelta(minutes=1))
+        deletion_queue.put((chat_id, list(array('q', message_ids))))
+        expired += 1
+    with store_lock, store:
+        store.execute('DELETE FROM sessions WHERE deadline <= ?', (now,))
+    count('bot_captchas_total', expired, result='expired')
+    return expired
+
+
+def restore_sessions(bot):
+    """Expire the overdue sessions, then load the others in chunks while the bot already answers updates"""
+    logger.debug('restore_sessions()')
+    started = monotonic()
+    now = time()
+    reader = None
+    try:
+        expired = expire_overdue_sessions(bot, now)
+        expired_at = monotonic()
+
+        restored = 0
+        # A connection of its own, the handlers keep writing meanwhile
+        reader = sqlite3.connect(STATE_DB)
+        rows = reader.execute('SELECT * FROM sessions WHERE deadline > ? ORDER BY deadline', (now,))
+        while True:
+            chunk = rows.fetchmany(SESSIONS_RESTORE_CHUNK)
+            if not chunk:
+                break
+            for chat_id, user_id, username, code_hash, deadline, attempts, message_ids in chunk:
+                if restore_session(CaptchaSession(chat_id, user_id, username, code_hash, deadline, attempts,
+                                                  array('q', message_ids))):
+                    restored += 1
+    finally:
+        if reader is not None:
+            reader.close()
+        # Answers no longer look in the store, even if the restore failed
+        with sessions_lock:
+            sessions_restored.set()
+            sessions_touched.clear()
+
+    logger.info('Expired %s overdue sessions in %.3fs, restored %s sessions in %.3fs',
+                expired, expired_at - started, restored, monotonic() - expired_at)
+
+
+class OldJobUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        # Callbacks of the pickled jobs may no longer exist, only their names are needed
+        if module in ('__main__', __name__):
+            return name
+        return super().find_class(module, name)
+
+
+def migrate_pickles():
+    """Move the state of the pickle based versions into the store"""
+    global chat_settings, ADMINS
+    global PERSONAL_LINK_CHAT, PERSONAL_LINK_PROGRESSOR, PERSONAL_LINK_DATING, PERSONAL_LINK_VK
+    try:
+        with open(DATA_PICKLE, 'rb') as fp:
+            captcha_time, goodbye_message, welcome_message, ADMINS = pickle.load(fp)
+            PERSONAL_LINK_CHAT, PERSONAL_LINK_PROGRESSOR, PERSONAL_LINK_DATING, PERSONAL_LINK_VK = pickle.load(fp)
+            registered = pickle.load(fp)
+        chat_ids = registered | captcha_time.keys() | welcome_message.keys() | goodbye_message.keys()
+        chat_settings = {chat_id: make_chat_settings(chat_id in registered, captcha_time.get(chat_id),
+                                                     welcome_message.get(chat_id), goodbye_message.get(chat_id), None)
+                         for chat_id in chat_ids}
+        load_acl([None, None, username] for username in ADMINS)
+        save_config_data()
+        logger.info('Migrated %s', DATA_PICKLE)
+    except FileNotFoundError:
+        # First run
+        pass
+
+    # The user id and the deadline of a captcha are only known from the user's kick job
+    jobs = {}
+    try:
+        with open(JOBS_PICKLE, 'rb') as fp:
+            unpickler = OldJobUnpickler(fp)
+            while True:
+                try:
+                    next_t, data, state = unpickler.load()
+                except EOFError:
+                    break  # loaded all jobs
+
+                job = dict(zip(JOB_DATA, data))
+                removed = state[0]
+                if job['callback'] == 'kick_on_time' and not removed:
+                    chat_id, username, user_id = job['context']
+                    jobs[chat_id, username] = user_id, next_t
+    except FileNotFoundError:
+        pass
+
+    try:
+        with open(TEMP_PICKLE, 'rb') as fp:
+            old_captchas = pickle.load(fp)
+            old_messages = pickle.load(fp)
+        for chat_id, users in old_captchas.items():
+            for username, code in users.items():
+                if (chat_id, username) in jobs:
+                    user_id, due = jobs[chat_id, username]
+                    save_session(CaptchaSession(chat_id, user_id, username, hash_code(code), due,
+                                                message_ids=old_messages[chat_id].get(username, [])))
+        flush_sessions()
+        logger.info('Migrated %s and %s', TEMP_PICKLE, JOBS_PICKLE)
+    except FileNotFoundError:
+        pass
 
 
 def personal_start(update, context):
     user = update.message.from_user
     logger.info("User %s started the conversation.", user.first_name)
-    reply_markup = draw_start_menu(user)
-    update.message.reply_text(
-        "Выберите интересующую информацию",
-        reply_markup=reply_markup
-    )
+    text, reply_markup = get_menu('start', is_bot_admin(user))
+    update.message.reply_text(text, reply_markup=reply_markup)
     return BEGIN
 
 
@@ -477,193 +2118,208 @@ def personal_start_over(update, context):
     query = update.callback_query
     user = query.from_user
     query.answer()
-    reply_markup = draw_start_menu(user)
-    query.edit_message_text(
-        "Выберите интересующую информацию",
-        reply_markup=reply_markup
-    )
+    text, reply_markup = get_menu('start', is_bot_admin(user))
+    query.edit_message_text(text, reply_markup=reply_markup)
     return BEGIN
 
 
-def draw_start_menu(user):
-    keyboard = [
-        [InlineKeyboardButton("Поличаты", callback_data=str(LINK_CHAT))],
-        [InlineKeyboardButton("Матчасть", callback_data=str(LINK_PROGRESSOR))],
-        [InlineKeyboardButton("Знакомства", callback_data=str(LINK_DATING))],
-        [InlineKeyboardButton("ВК", callback_data=str(LINK_VK))]
-    ]
-    if user.username in ADMINS:
-        keyboard.append([InlineKeyboardButton("Админка", callback_data=str(ADMIN))])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    return reply_markup
-
-
-def personal_link_chat(update, context):
+def personal_link(update, context):
+    """Any of the link pages, the callback data names the page"""
     query = update.callback_query
     query.answer()
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data=str(RESTART))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text, reply_markup = get_menu('link', query.data)
     query.edit_message_text(
-        text=PERSONAL_LINK_CHAT,
+        text=text,
         reply_markup=reply_markup,
         parse_mode=ParseMode.MARKDOWN
     )
     return END
 
 
-def personal_link_progressor(update, context):
+def personal_admin_panel(update, context):
     query = update.callback_query
+    user = query.from_user
     query.answer()
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data=str(RESTART))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text, reply_markup = get_menu('admin', user.username == SUPER_ADMIN)
     query.edit_message_text(
-        text=PERSONAL_LINK_PROGRESSOR,
-        reply_markup=reply_markup,
-        parse_mode=ParseMode.MARKDOWN
+        text=text,
+        reply_markup=reply_markup
     )
     return END
 
 
-def personal_link_dating(update, context):
-    query = update.callback_query
-    query.answer()
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data=str(RESTART))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(
-        text=PERSONAL_LINK_DATING,
-        reply_markup=reply_markup,
-        parse_mode=ParseMode.MARKDOWN
-    )
-    return END
+def back_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=str(RESTART))]]).to_json()
 
 
-def personal_link_vk(update, context):
-    query = update.callback_query
-    query.answer()
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data=str(RESTART))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(
-        text=PERSONAL_LINK_VK,
-        reply_markup=reply_markup,
-        parse_mode=ParseMode.MARKDOWN
-    )
-    return END
+def build_start_menu(is_admin):
+    keyboard = [[InlineKeyboardButton(title, callback_data=page)] for page, title in LINK_PAGES]
+    if is_admin:
+        keyboard.append([InlineKeyboardButton("Админка", callback_data=str(ADMIN))])
+    return "Выберите интересующую информацию", InlineKeyboardMarkup(keyboard).to_json()
 
 
-def personal_admin_panel(update, context):
-    query = update.callback_query
-    user = query.from_user
-    query.answer()
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data=str(RESTART))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+def build_link_page(page):
+    links = {LINK_CHAT: PERSONAL_LINK_CHAT, LINK_PROGRESSOR: PERSONAL_LINK_PROGRESSOR,
+             LINK_DATING: PERSONAL_LINK_DATING, LINK_VK: PERSONAL_LINK_VK}
+    return links[page], back_keyboard()
+
+
+def build_admin_panel(is_super_admin):
     text = """Additional Admin Commands:
         /set_link_chat <chat_link_message>
         /set_link_progressor <progressor_link_message>
         /set_link_dating <dating_link_message>
-        /set_link_vk <vk_link_message>""";
-    if user.username == SUPER_ADMIN:
+        /set_link_vk <vk_link_message>"""
+    if is_super_admin:
         text += """
         /list_admin
-        /add_admin <username>
-        /remove_admin <username>"""
-    query.edit_message_text(
-        text=text,
-        reply_markup=reply_markup
-    )
-    return END
+        /add_admin <username or user id>
+        /remove_admin <username or user id>
+        In a group chat these manage the admins of that chat, the user may also be given by a reply"""
+    return text, back_keyboard()
+
+
+# menu -> builder of (text, keyboard JSON) from the variant
+MENUS = {'start': build_start_menu, 'link': build_link_page, 'admin': build_admin_panel}
+
+
+def get_menu(menu, variant):
+    """The text and keyboard of a menu, the keyboard is serialized once and sent as is"""
+    with menu_cache_lock:
+        cached = menu_cache.get((menu, variant))
+        if cached is None:
+            cached = menu_cache[menu, variant] = MENUS[menu](variant)
+    return cached
+
+
+def invalidate_menus():
+    with menu_cache_lock:
+        menu_cache.clear()
 
 
 def set_personal_link_chat(update, context):
     global PERSONAL_LINK_CHAT
-    logger.debug('set_personal_link_chat %s', update)
-    if update.message.from_user.username not in ADMINS:
+    logger.debug('set_personal_link_chat')
+    if not is_bot_admin(update.message.from_user):
         return
 
     msg = update.message.text.split(None, 1)[1]
     PERSONAL_LINK_CHAT = msg
     update.message.reply_text("Принято. Новое сообщение:\n" + msg, parse_mode=ParseMode.MARKDOWN)
-    save_config_data()
+    invalidate_menus()
+    save_setting('link_chat', msg)
 
 
 def set_personal_link_progressor(update, context):
     global PERSONAL_LINK_PROGRESSOR
-    logger.debug('set_personal_link_progressor %s', update)
-    if not (update.message.from_user.username in ADMINS):
+    logger.debug('set_personal_link_progressor')
+    if not is_bot_admin(update.message.from_user):
         return
 
     msg = update.message.text.split(None, 1)[1]
     PERSONAL_LINK_PROGRESSOR = msg
     update.message.reply_text("Принято. Новое сообщение:\n" + msg, parse_mode=ParseMode.MARKDOWN)
-    save_config_data()
+    invalidate_menus()
+    save_setting('link_progressor', msg)
 
 
 def set_personal_link_dating(update, context):
     global PERSONAL_LINK_DATING
-    logger.debug('set_personal_link_dating %s', update)
-    if not (update.message.from_user.username in ADMINS):
+    logger.debug('set_personal_link_dating')
+    if not is_bot_admin(update.message.from_user):
         return
 
     msg = update.message.text.split(None, 1)[1]
     PERSONAL_LINK_DATING = msg
     update.message.reply_text("Принято. Новое сообщение:\n" + msg, parse_mode=ParseMode.MARKDOWN)
-    save_config_data()
+    invalidate_menus()
+    save_setting('link_dating', msg)
 
 
 def set_personal_link_vk(update, context):
     global PERSONAL_LINK_VK
-    logger.debug('set_personal_link_vk %s', update)
-    if not (update.message.from_user.username in ADMINS):
+    logger.debug('set_personal_link_vk')
+    if not is_bot_admin(update.message.from_user):
         return
 
     msg = update.message.text.split(None, 1)[1]
     PERSONAL_LINK_VK = msg
     update.message.reply_text("Принято. Новое сообщение:\n" + msg, parse_mode=ParseMode.MARKDOWN)
-    save_config_data()
+    invalidate_menus()
+    save_setting('link_vk', msg)
+
+
+def acl_target(update, context):
+    """The (user_id, username) an ACL command is about, from the replied message or the first argument"""
+    reply = update.message.reply_to_message
+    if reply is not None:
+        return reply.from_user.id, reply.from_user.username
+    if not context.args:
+        return None, None
+    target = context.args[0].lstrip('@')
+    if target.isdigit():
+        return int(target), None
+    return None, target
+
+
+def acl_scope(update):
+    # Group commands manage the admins of that group, private ones the admins of the bot
+    return None if update.message.chat.type == 'private' else update.message.chat_id
 
 
 def list_personal_admin(update, context):
-    logger.debug('list_personal_admin %s', update)
+    logger.debug('list_personal_admin')
     if update.message.from_user.username != SUPER_ADMIN:
         return
 
-    update.message.reply_text(', '.join(ADMINS))
+    with acl_lock:
+        acl = acls.get(acl_scope(update), Acl())
+        names = ['@' + username if username else str(user_id) for user_id, username in acl.members.items()]
+        names.extend('@' + username + ' (?)' for username in acl.pending)
+    update.message.reply_text(', '.join(names) or '-')
 
 
 def add_personal_admin(update, context):
-    logger.debug('add_personal_admin %s', update)
+    logger.debug('add_personal_admin')
     if update.message.from_user.username != SUPER_ADMIN:
         return
 
-    username = context.args[0]
-    ADMINS.append(username)
+    user_id, username = acl_target(update, context)
+    if user_id is None and username is None:
+        update.message.reply_text('Usage: /add_admin <username or user id>')
+        return
+    with acl_lock:
+        acl = acls.setdefault(acl_scope(update), Acl())
+        if user_id is None:
+            acl.add_name(username)
+        else:
+            acl.add(user_id, username)
+    invalidate_menus()
     update.message.reply_text("Added")
-    save_config_data()
+    save_acl()
 
 
 def remove_personal_admin(update, context):
-    logger.debug('remove_personal_admin %s', update)
+    logger.debug('remove_personal_admin')
     if update.message.from_user.username != SUPER_ADMIN:
         return
 
-    username = context.args[0]
-    ADMINS.remove(username)
+    user_id, username = acl_target(update, context)
+    with acl_lock:
+        acl = acls.get(acl_scope(update))
+        removed = acl is not None and acl.remove(user_id, username)
+    if not removed:
+        update.message.reply_text("Not found")
+        return
+    invalidate_menus()
     update.message.reply_text("Removed")
-    save_config_data()
+    save_acl()
 
 
+@timed
 def register_chat(update, context):
-    global INSTANCE_CHAT_ID
-    logger.debug('register_chat %s', update)
+    logger.debug('register_chat')
     if update.message.from_user.username != SUPER_ADMIN:
         return
 
@@ -671,44 +2327,336 @@ def register_chat(update, context):
         return
 
     chat_id = update.message.chat_id
-    INSTANCE_CHAT_ID.add(chat_id)
-
-    CAPTCHA_TIME[chat_id] = DEFAULT_CAPTCHA_TIME
-    WELCOME_MESSAGE[chat_id] = DEFAULT_WELCOME_MESSAGE
-    GOODBYE_MESSAGE[chat_id] = DEFAULT_GOODBYE_MESSAGE
-    captchas[chat_id] = {}
-    messages_to_delete[chat_id] = {}
-
+    update_chat_settings(chat_id, registered=True, captcha_time=DEFAULT_CAPTCHA_TIME,
+                         welcome_message=DEFAULT_WELCOME_MESSAGE, goodbye_message=DEFAULT_GOODBYE_MESSAGE)
     update.message.reply_text("Готово!")
-    save_config_data()
 
 
+@timed
 def unregister_chat(update, context):
-    global INSTANCE_CHAT_ID
-    logger.debug('unregister_chat %s', update)
+    logger.debug('unregister_chat')
     if update.message.from_user.username != SUPER_ADMIN:
         return
 
     if update.message.chat.type != 'supergroup':
         return
 
-    INSTANCE_CHAT_ID.remove(update.message.chat_id)
+    chat_id = update.message.chat_id
+    update_chat_settings(chat_id, registered=False)
+    invalidate_chat_admins(chat_id)
     update.message.reply_text("Готово!")
-    save_config_data()
 
 
-def main():
-    """Start the bot."""
-    updater = Updater(TOKEN, use_context=True)
+def dispatch_to_lane(lanes, dispatcher, executor, update):
+    """Queue the update behind the other updates of its chat"""
+    chat_id = update.effective_chat.id if update.effective_chat else None
+    if chat_id in lanes:
+        lanes[chat_id].append(update)
+    else:
+        lanes[chat_id] = deque([update])
+        asyncio.ensure_future(run_lane(lanes, chat_id, dispatcher, executor))
+
+
+async def run_lane(lanes, chat_id, dispatcher, executor):
+    """Process the updates of one chat in order, without waiting for other chats"""
+    loop = asyncio.get_event_loop()
+    lane = lanes[chat_id]
+    while lane:
+        update = lane.popleft()
+        await loop.run_in_executor(executor, dispatcher.process_update, update)
+    del lanes[chat_id]
+
+
+async def poll_updates(updater, stopping):
+    loop = asyncio.get_event_loop()
+    bot = updater.bot
+    lanes = {}
+    offset = None
+    backoff = 1
+    stop = asyncio.ensure_future(stopping.wait())
+
+    with ThreadPoolExecutor(ASYNC_HANDLER_WORKERS, thread_name_prefix='handler') as executor:
+        await loop.run_in_executor(executor, bot.delete_webhook)
+        logger.info('Ready to go')
+
+        while not stopping.is_set():
+            poll = loop.run_in_executor(None, partial(bot.get_updates, offset=offset, timeout=ASYNC_POLL_TIMEOUT))
+            await asyncio.wait((poll, stop), return_when=asyncio.FIRST_COMPLETED)
+            if not poll.done():
+                # The offset was not confirmed, Telegram sends these updates again after a restart
+                break
 
-    job_queue = updater.job_queue
+            try:
+                updates = poll.result()
+            except TelegramError as e:
+                logger.warning('Could not get updates: %s', e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            backoff = 1
+
+            for update in updates:
+                offset = update.update_id + 1
+                dispatch_to_lane(lanes, updater.dispatcher, executor, update)
+
+        while lanes:
+            await asyncio.sleep(0.1)
+
+
+def run_asyncio(updater):
+    loop = asyncio.get_event_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    updater.job_queue.start()
+    try:
+        loop.run_until_complete(poll_updates(updater, stopping))
+    finally:
+        updater.job_queue.stop()
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, bot):
+        super().__init__(address, WebhookHandler)
+        self.bot = bot
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.respond(404)
+            return
+
+        # Headers are decoded as latin-1, compare_digest only takes ASCII strings
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode('latin-1')
+        if not hmac.compare_digest(secret, WEBHOOK_SECRET.encode('utf-8')):
+            self.respond(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.respond(400)
+            return
+        if length > WEBHOOK_MAX_BODY:
+            self.respond(413)
+            return
+
+        body = self.rfile.read(length)
+        try:
+            data = json.loads(body.decode('utf-8'))
+            # Any other JSON value fails inside de_json with an AttributeError
+            update = Update.de_json(data, self.server.bot) if isinstance(data, dict) else None
+        except (ValueError, TypeError, KeyError):
+            update = None
+        if update is None:
+            self.respond(400)
+            return
+
+        try:
+            webhook_queue.put_nowait(update)
+        except queue.Full:
+            # Telegram keeps the update and delivers it again later
+            self.respond(503, {'Retry-After': '1'})
+            return
+
+        if webhook_record is not None:
+            with webhook_record_lock:
+                webhook_record.write(body.decode('utf-8') + '\n')
+        self.respond(200)
 
-    dp = updater.dispatcher
+    def respond(self, code, headers=None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug('webhook %s', format % args)
+
+
+def run_webhook_dispatcher(dispatcher):
+    while True:
+        update = webhook_queue.get()
+        if update is None:
+            return
+        dispatcher.process_update(update)
+
+
+def set_webhook(bot):
+    # This python-telegram-bot version does not know the secret_token parameter
+    bot._request.post('{}/setWebhook'.format(bot.base_url),
+                      {'url': WEBHOOK_URL + WEBHOOK_PATH, 'secret_token': WEBHOOK_SECRET})
+
+
+def run_webhook(updater):
+    global webhook_record
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stopping.set())
+
+    if WEBHOOK_RECORD_FILE:
+        webhook_record = open(WEBHOOK_RECORD_FILE, 'a', encoding='utf-8')
+
+    server = WebhookServer((WEBHOOK_LISTEN, WEBHOOK_PORT), updater.bot)
+    dispatcher = threading.Thread(target=run_webhook_dispatcher, args=(updater.dispatcher,), name='dispatcher')
+    dispatcher.start()
+    updater.job_queue.start()
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    if WEBHOOK_URL:
+        set_webhook(updater.bot)
+    logger.info('Ready to go, listening on %s:%s%s', WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    stopping.wait()
+
+    server.shutdown()
+    server.server_close()
+    # Updates already accepted are still handled
+    webhook_queue.put(None)
+    dispatcher.join()
+    updater.job_queue.stop()
+    if webhook_record is not None:
+        webhook_record.close()
+
+
+def shard_of(update):
+    """Group chats are spread by chat id, private chats go to shard 0 which keeps the personal links and admins"""
+    chat = update.effective_chat
+    if chat is None or chat.type == 'private':
+        return 0
+    return abs(chat.id) % SHARDS
+
+
+def split_store(index):
+    """Copy this shard's part of a STATE_DB written by an unsharded run"""
+    with store_lock, store:
+        store.execute('ATTACH DATABASE ? AS unsharded', (UNSHARDED_STATE_DB,))
+    with store_lock, store:
+        store.execute('INSERT OR REPLACE INTO chats SELECT * FROM unsharded.chats WHERE abs(chat_id) % ? = ?',
+                      (SHARDS, index))
+        store.execute('INSERT OR REPLACE INTO sessions SELECT * FROM unsharded.sessions WHERE abs(chat_id) % ? = ?',
+                      (SHARDS, index))
+        # Every shard checks the ACL and shows the links
+        store.execute('INSERT OR REPLACE INTO settings SELECT * FROM unsharded.settings')
+    with store_lock, store:
+        store.execute('DETACH DATABASE unsharded')
+    logger.info('Copied shard %s from %s', index, UNSHARDED_STATE_DB)
+
+
+def run_shard(index, updates):
+    """Handle the updates of one partition of the chats, with its own state and store"""
+    global STATE_DB, OUTBOUND_GLOBAL_RATE, CAPTCHA_RENDER_PROCESSES
+    # The router stops the shards once it stopped polling
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # The writer thread of the router did not come along with the fork
+    start_logging()
+
+    STATE_DB = SHARD_STATE_DB.format(index)
+    # Telegram limits the bot as a whole
+    OUTBOUND_GLOBAL_RATE = OUTBOUND_GLOBAL_RATE / SHARDS
+    # Daemonic processes can't have children, the shards themselves spread the rendering over the cores
+    CAPTCHA_RENDER_PROCESSES = 0
+    split = not os.path.exists(STATE_DB) and os.path.exists(UNSHARDED_STATE_DB)
+
+    updater = Updater(bot=make_bot(), use_context=True)
+    add_handlers(updater.dispatcher)
+    start_metrics_server(None if METRICS_PORT is None else METRICS_PORT + 1 + index)
+    start_services(updater, split_from=index if split else None)
+    updater.job_queue.start()
+    logger.info('Shard %s ready', index)
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        updater.dispatcher.process_update(Update.de_json(data, updater.bot))
+
+    updater.job_queue.stop()
+    stop_services()
+    stop_logging()
+
+
+def put_to_shard(shard, updates, data, stopping=None):
+    """Queue data for a shard while it's behind, returns False once it died or the router is stopping"""
+    while stopping is None or not stopping.is_set():
+        if not shard.is_alive():
+            return False
+        try:
+            updates.put(data, timeout=SHARD_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def run_router():
+    """Poll for updates and hand them to the shards, returns False if a shard died"""
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stopping.set())
+
+    if not any(os.path.exists(SHARD_STATE_DB.format(index)) for index in range(SHARDS)):
+        # Imports the pickles of an older version into STATE_DB, which the shards then split
+        open_store()
+        close_store()
+
+    queues = [multiprocessing.Queue(SHARD_QUEUE_SIZE) for _ in range(SHARDS)]
+    shards = [multiprocessing.Process(target=run_shard, args=(index, updates), name='shard-{}'.format(index),
+                                      daemon=True)
+              for index, updates in enumerate(queues)]
+    for shard in shards:
+        shard.start()
+
+    start_metrics_server(METRICS_PORT)
+    bot = make_bot()
+    bot.delete_webhook()
+    logger.info('Ready to go, routing to %s shards', SHARDS)
+
+    offset = None
+    while not stopping.is_set() and all(shard.is_alive() for shard in shards):
+        try:
+            updates = bot.get_updates(offset=offset, timeout=ASYNC_POLL_TIMEOUT)
+        except TelegramError as e:
+            logger.warning('Could not get updates: %s', e)
+            stopping.wait(1)
+            continue
+
+        for update in updates:
+            index = shard_of(update)
+            # Blocks while the shard is behind, which holds back polling
+            if not put_to_shard(shards[index], queues[index], update.to_dict(), stopping):
+                # Not confirmed to Telegram, it's delivered again on the next start
+                break
+            offset = update.update_id + 1
+
+    dead = [shard.name for shard in shards if not shard.is_alive()]
+    if dead:
+        logger.error('Shards %s stopped, stopping the others', ', '.join(dead))
+    for shard, updates in zip(shards, queues):
+        if not put_to_shard(shard, updates, None):
+            # Nobody reads the queue any more, exiting must not wait for it to be flushed
+            updates.cancel_join_thread()
+    for shard in shards:
+        shard.join()
+    return not dead
+
+
+def add_handlers(dp):
+    # Runs first, raising DispatcherHandlerStop keeps the update from all other handlers
+    dp.add_handler(TypeHandler(Update, filter_update), group=-1)
 
     dp.add_handler(CommandHandler("help", show_help_message))
     dp.add_handler(CommandHandler("set_welcome_msg", set_welcome_message))
     dp.add_handler(CommandHandler("set_goodbye_msg", set_goodbye_message))
     dp.add_handler(CommandHandler("set_captcha_time", set_captcha_time))
+    dp.add_handler(CommandHandler("set_admin_triggers", set_admin_triggers))
     dp.add_handler(CommandHandler("kick", kick_user))
     dp.add_handler(CommandHandler("ban", ban_user))
     dp.add_handler(CommandHandler("mute", mute_user))
@@ -731,10 +2679,8 @@ def main():
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', personal_start)],
         states={
-            BEGIN: [CallbackQueryHandler(personal_link_chat, pattern='^' + str(LINK_CHAT) + '$'),
-                    CallbackQueryHandler(personal_link_progressor, pattern='^' + str(LINK_PROGRESSOR) + '$'),
-                    CallbackQueryHandler(personal_link_dating, pattern='^' + str(LINK_DATING) + '$'),
-                    CallbackQueryHandler(personal_link_vk, pattern='^' + str(LINK_VK) + '$'),
+            BEGIN: [CallbackQueryHandler(personal_link,
+                                         pattern='^(' + '|'.join(re.escape(page) for page, title in LINK_PAGES) + ')$'),
                     CallbackQueryHandler(personal_admin_panel, pattern='^' + str(ADMIN) + '$')],
             END: [CallbackQueryHandler(personal_start_over, pattern='^' + str(RESTART) + '$')]
         },
@@ -745,36 +2691,71 @@ def main():
 
     dp.add_error_handler(error)
 
-    try:
-        load_config_data()
-    except FileNotFoundError:
-        # First run
-        pass
 
-    try:
-        load_jobs(job_queue)
-    except FileNotFoundError:
-        # First run
-        pass
+def start_services(updater, split_from=None):
+    job_queue = updater.job_queue
+
+    started = monotonic()
+    open_store()
+    if split_from is not None:
+        split_store(split_from)
+    opened_at = monotonic()
+    # Only the config is needed to answer updates, the sessions follow in the background
+    load_config_data()
+    logger.info('Opened the store in %.3fs, loaded the config of %s chats in %.3fs',
+                opened_at - started, len(chat_settings), monotonic() - opened_at)
+
+    job_queue.run_repeating(expire_captchas_job, WHEEL_TICK)
+    job_queue.run_repeating(refresh_admin_cache_job, ADMIN_CACHE_REFRESH_AHEAD / 2)
+    job_queue.run_repeating(end_raids_job, 10)
+
+    start_captcha_pool()
+    start_outbound_scheduler()
+    start_deletion_worker(updater.bot)
+    start_sessions_flusher()
+    threading.Thread(target=restore_sessions, args=(updater.bot,), name='restore_sessions', daemon=True).start()
+
+
+def stop_services():
+    stop_captcha_pool()
+    stop_deletion_worker()
+    stop_outbound_scheduler()
+    stop_sessions_flusher()
+    logger.info('Session flushes: %(flushes)s, changes: %(changes)s, coalesced: %(coalesced)s, '
+                'chats: %(chats)s', sessions_flush_stats)
+    close_store()
 
-    try:
-        load_temp_data()
-    except FileNotFoundError:
-        # First run
-        pass
 
-    job_queue.run_repeating(save_jobs_job, timedelta(minutes=1))
-    job_queue.run_repeating(save_temp_job, timedelta(minutes=1))
+def main():
+    """Start the bot."""
+    start_logging()
+    if RUN_MODE == 'sharded':
+        shards_alive = run_router()
+        stop_logging()
+        if not shards_alive:
+            sys.exit(1)
+        return
 
-    updater.start_polling()
+    updater = Updater(bot=make_bot(), use_context=True)
+
+    add_handlers(updater.dispatcher)
+    start_metrics_server(METRICS_PORT)
+
+    start_services(updater)
+
+    if RUN_MODE == 'asyncio':
+        run_asyncio(updater)
+    elif RUN_MODE == 'webhook':
+        run_webhook(updater)
+    else:
+        updater.start_polling()
 
-    logger.info('Ready to go')
+        logger.info('Ready to go')
 
-    updater.idle()
+        updater.idle()
 
-    save_config_data()
-    save_jobs(job_queue)
-    save_temp_data()
+    stop_services()
+    stop_logging()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Replays recorded updates against the webhook of a locally running bot.
+Updates are read from a file with one update JSON per line, as written by the bot
+when WEBHOOK_RECORD_FILE is set. Prints the throughput and latency of the webhook.
+Usage:
+python3 replay.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret <WEBHOOK SECRET TOKEN>
+"""
+
+import argparse
+import itertools
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+def post_update(url, secret, body):
+    request = Request(url, data=body, headers={'Content-Type': 'application/json',
+                                                'X-Telegram-Bot-Api-Secret-Token': secret})
+    started = monotonic()
+    try:
+        with urlopen(request, timeout=10) as response:
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    except OSError:
+        # URLError, and the connection errors of an overloaded server
+        status = 'error'
+    return status, monotonic() - started
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded updates against the bot webhook')
+    parser.add_argument('updates', help='file with one update JSON per line')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret', default='<WEBHOOK SECRET TOKEN>')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the file this many times')
+    args = parser.parse_args()
+
+    with open(args.updates, encoding='utf-8') as fp:
+        updates = [json.loads(line) for line in fp if line.strip()]
+
+    # Every copy gets its own update id, as it would coming from Telegram
+    next_id = itertools.count(max((update['update_id'] for update in updates), default=0) + 1)
+    bodies = []
+    for update in itertools.chain.from_iterable(itertools.repeat(updates, args.repeat)):
+        bodies.append(json.dumps(dict(update, update_id=next(next_id))).encode('utf-8'))
+
+    started = monotonic()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(lambda body: post_update(args.url, args.secret, body), bodies))
+    elapsed = monotonic() - started
+
+    statuses = Counter(status for status, latency in results)
+    latencies = sorted(latency for status, latency in results)
+    print('updates: {}, seconds: {:.3f}, updates/s: {:.1f}'.format(len(results), elapsed, len(results) / elapsed))
+    print('latency p50: {:.4f}s, p99: {:.4f}s'.format(percentile(latencies, 0.5), percentile(latencies, 0.99)))
+    print('statuses: ' + ', '.join('{}: {}'.format(status, count) for status, count in sorted(statuses.items(), key=str)))
+
+
+if __name__ == '__main__':
+    main()